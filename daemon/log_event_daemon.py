@@ -2,32 +2,84 @@
 # -*- coding: utf-8 -*-
 # ----------------------------------------------------------------------------------------------------------------------
 import argparse
+import array
+import ast
+import asyncio
+import collections
+import concurrent.futures
+import ctypes
 import datetime
+import fnmatch
+import glob
+import gzip
+import http.server
+import json
+import math
+import multiprocessing
+import operator
 import os
-import queue
 import re
+import resource
 import signal
 import socket
-import subprocess
+import socketserver
+import stat
+import struct
 import sys
 import tempfile
 import threading
+import time
 import traceback
-from time import sleep
 from typing import Union
 
 __START_DT = datetime.datetime.now()
 __HOSTNAME = socket.getfqdn()
 __GLOBAL = {'stop': False, 'return': True}
 
-LogQueue = queue.Queue(4096)
-CmdQueue = queue.Queue(1024)
+LogQueue = asyncio.Queue(64)  # Batches: the lines of one read, up to _READ_CHUNK bytes, and the offsets after it
+Marks = {}  # path: the offsets after the last batch processed, saved by the checkpoints
+Stages = {}  # The replay mode: stage: [seconds per batch]
+Readers = {'files': ()}  # The metrics: (path, ino, dev, offset) of the followers, a tuple replaced by the event loop
+Counters = {'lines': 0, 'decoded': 0, 'skipped': 0, 'decode_errors': 0, 'parsed': 0, 'parse_errors': 0,
+            'match_seconds': 0.0, 'dropped': 0, 'spilled': 0, 'coalesced': 0,
+            'actions': 0, 'actions_failed': 0, 'actions_timeout': 0, 'actions_dropped': 0}  # Event loop only
 
-# demo
-re_log_entry_1 = re.compile(r'^done$')
-action_1_cmd = '''echo "$(date) ok" > /tmp/action.log'''
-action_1_repeat_interval = 60  # The time to wait before repeat an action, in seconds.
-action_1_buffer = {'last': datetime.datetime.min}
+_READ_CHUNK = 1024 * 1024  # Bytes per os.read of a followed file
+_WAIT_INTERVAL = 1  # Seconds between rotation checks with inotify
+_POLL_INTERVAL = 0.25  # Seconds between reads without inotify
+_RESCAN_INTERVAL = 5  # Seconds between glob rescans without inotify
+_ACTIONS_PENDING_MAX = 1024  # Actions started or waiting for a slot, the next ones are dropped
+_SPILL_SEGMENT = 64 * 1024 * 1024  # Bytes per segment file of the spill log
+_SPILL_INTERVAL = 0.05  # Seconds between the replays of the spill log
+_LATENCY_BUCKETS = (0.01, 0.1, 0.5, 1, 5, 10, 60)  # Seconds, the action duration histogram
+_METRICS_PREFIX = "log_event_daemon"
+_WINDOW_BUCKETS = 12  # Buckets per sliding window: the window slides by 1/12 of its length
+_WINDOW_KEYS_ENV_MAX = 65536  # Bytes of LOG_EVENT_KEYS, an environment string is limited to 128 KiB
+# Field conditions: the formats and their parsers
+_FORMATS = ['json', 'logfmt', 'nginx']
+_RE_LOGFMT = re.compile(r'([\w.\-]+)=("(?:[^"\\]|\\.)*"|\S*)')
+_RE_PREDICATE_NEEDLE = re.compile(r'^[A-Za-z0-9_.\-]+$')  # Never escaped in a JSON line
+_RE_NGINX_COMBINED = re.compile(r'(?P<remote_addr>\S+) \S+ (?P<remote_user>\S+) \[(?P<time_local>[^]]*)] '
+                                r'"(?P<request>(?P<method>[A-Z]+) (?P<uri>\S+)(?: (?P<protocol>[^"]*))?|[^"]*)" '
+                                r'(?P<status>\d+) (?P<body_bytes_sent>\d+|-)'
+                                r'(?: "(?P<http_referer>[^"]*)" "(?P<http_user_agent>[^"]*)")?')
+# The replay mode: timestamps of the lines, ISO 8601 (or the nginx error log one) or the nginx/apache access log one
+_RE_REPLAY_ISO = re.compile(rb'(\d{4})[-/](\d\d)[-/](\d\d)[T ](\d\d):(\d\d):(\d\d)(?:[.,](\d{1,6}))?')
+_RE_REPLAY_CLF = re.compile(rb'(\d\d)/([A-Z][a-z]{2})/(\d{4}):(\d\d):(\d\d):(\d\d)')
+_MONTHS = {x.encode(): i + 1 for i, x in enumerate(['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+                                                    'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'])}
+_PREDICATE_OPERATORS = {ast.Eq: operator.eq, ast.NotEq: operator.ne, ast.Lt: operator.lt, ast.LtE: operator.le,
+                        ast.Gt: operator.gt, ast.GtE: operator.ge,
+                        ast.In: lambda a, b: a in b, ast.NotIn: lambda a, b: a not in b}
+_MATCHER = {}  # The rules of the matcher thread or process
+# inotify(7)
+_IN_MODIFY = 0x00000002
+_IN_ATTRIB = 0x00000004
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_Q_OVERFLOW = 0x00004000
 
 
 def main():
@@ -35,108 +87,140 @@ def main():
     # command-line options, arguments
     try:
         parser = argparse.ArgumentParser(
-            description='Continuously watches a single file and reacts to regex-matched lines.')
-        parser.add_argument('file', action='store', type=str,
-                            metavar="<FILE>", help="File to watch for new lines")
+            description='Continuously watches files and reacts to regex-matched lines.')
+        parser.add_argument('files', action='store', type=str, nargs='*',
+                            metavar="<FILE>", help="files or glob patterns to watch for new lines")
+        parser.add_argument('--replay', action='store', type=str, default="",
+                            metavar="", help="benchmark: feed the lines of a recorded log (.gz too) instead of "
+                                             "watching files, the actions are printed, not run")
+        parser.add_argument('--replay-speed', action='store', type=float, default=0,
+                            metavar="", help="replay at this multiple of the pace of the line timestamps, "
+                                             "0 for as fast as possible (default: %(default)s)")
+        parser.add_argument('--replay-as', action='store', type=str, default="",
+                            metavar="", help="path of the replayed lines for the rule scopes, "
+                                             "e.g. /var/log/nginx/access.log (default: the --replay file)")
+        parser.add_argument('-r', '--rules', action='store', type=str,
+                            default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'log_event_daemon.yaml'),
+                            metavar="", help="rules file (default: %(default)s)")
+        parser.add_argument('--decode-errors', action='store', choices=['strict', 'replace'], default='replace',
+                            help="UTF-8 decoding of the matched lines: skip the invalid ones or replace the invalid "
+                                 "bytes (default: %(default)s)")
+        parser.add_argument('-w', '--workers', action='store', type=int, default=0,
+                            metavar="", help="matcher processes, 0 to match in a thread "
+                                             "(default: %(default)s)")
+        parser.add_argument('--max-actions', action='store', type=int, default=16,
+                            metavar="", help="actions running at the same time, all rules together "
+                                             "(default: %(default)s)")
+        parser.add_argument('--output-limit', action='store', type=int, default=65536,
+                            metavar="", help="bytes of the action output kept for the log (default: %(default)s)")
+        parser.add_argument('--stats-interval', action='store', type=int, default=60,
+                            metavar="", help="seconds between the counters reports, 0 to disable "
+                                             "(default: %(default)s)")
+        parser.add_argument('--state-file', action='store', type=str,
+                            default=os.path.join(tempfile.gettempdir(), os.path.basename(sys.argv[0]) + '.state.json'),
+                            metavar="", help="read offsets file to resume from (default: %(default)s)")
+        parser.add_argument('--checkpoint-interval', action='store', type=int, default=5,
+                            metavar="", help="seconds between read offsets checkpoints (default: %(default)s)")
+        parser.add_argument('--checkpoint-lines', action='store', type=int, default=10000,
+                            metavar="", help="lines between read offsets checkpoints (default: %(default)s)")
+        parser.add_argument('--overload', action='store', choices=['block', 'drop-oldest', 'sample', 'spill'],
+                            default='block', help="policy when the matching falls behind: block the reading, "
+                                                  "drop the oldest lines, keep 1 line in --sample-rate, or spill "
+                                                  "the lines to --spill-dir (default: %(default)s)")
+        parser.add_argument('--sample-rate', action='store', type=int, default=10,
+                            metavar="", help="1 line in N kept by the sample policy (default: %(default)s)")
+        parser.add_argument('--spill-dir', action='store', type=str, default="",
+                            metavar="", help="spill log directory (default: the state file path + .spill)")
+        parser.add_argument('--spill-max', action='store', type=int, default=1024,
+                            metavar="", help="MiB of lines in the spill log, the reading blocks beyond "
+                                             "(default: %(default)s)")
+        parser.add_argument('--metrics', action='store', type=str, default="",
+                            metavar="", help="metrics endpoint in the Prometheus text format: [host:]port (default "
+                                             "host: 127.0.0.1) or the path of a Unix socket (default: disabled)")
         parser.add_argument('-n', '--dry-run', action='store_true',
                             help="testing mode with no changes made")
         args = parser.parse_args()  # <class 'argparse.Namespace'>
     except SystemExit:
         return False
-    # ==================================================================================================================
-    # ==================================================================================================================
-    # Init threads
-    # ==================================================================================================================
-    thread_reader = ThreadReader(name="ThreadReader", dry_run=args.dry_run)
-    if not thread_reader.trg_init:
-        print(f"[EE] Failed init thread: {thread_reader.name}", flush=True)
+    if args.checkpoint_interval < 1 or args.checkpoint_lines < 1 or args.workers < 0:
+        print("[EE] Invalid --checkpoint-interval, --checkpoint-lines or --workers value", flush=True)
         return False
-    # __________________________________________________________________________
-    thread_commander = ThreadCommander(name="ThreadCommander", dry_run=args.dry_run)
-    if not thread_commander.trg_init:
-        print(f"[EE] Failed init thread: {thread_commander.name}", flush=True)
+    if args.max_actions < 1 or args.output_limit < 0:
+        print("[EE] Invalid --max-actions or --output-limit value", flush=True)
+        return False
+    if args.sample_rate < 1 or args.spill_max < 1:
+        print("[EE] Invalid --sample-rate or --spill-max value", flush=True)
+        return False
+    if not args.files and not args.replay:
+        print("[EE] No files to watch nor --replay", flush=True)
         return False
+    if args.replay_speed < 0:
+        print("[EE] Invalid --replay-speed value", flush=True)
+        return False
+    if args.replay:
+        args.dry_run = True  # No pid file nor state, the actions are printed
+        Stages.update({x: [] for x in ['read', 'queue', 'match', 'process', 'total']})
+    rules = rules_load(args.rules)
+    if rules is None:
+        return False
+    print(f"[..] Rules [{len(rules)}]: {', '.join(x['name'] for x in rules)}", flush=True)
     # ==================================================================================================================
     # ==================================================================================================================
-    # Open subprocess
+    # Follow file
     # ==================================================================================================================
     if args.dry_run:
         # ______________________________________________________________________
         # PID
         pid_file_path = None
-        # ______________________________________________________________________
-        # cat
         print("[WW] DRY RUN MODE", flush=True)
-        cmd = f'''export LC_ALL=""; export LANG="en_US.UTF-8"; cat "{args.file}"'''
-        child = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        print(f"[..] Running subprocess with PID: {child.pid}", flush=True)
     else:
         # ______________________________________________________________________
         # PID
         pid_file_path = os.path.join(tempfile.gettempdir(), os.path.basename(sys.argv[0]) + '.pid')
         if not pid_mk_file(pid_file_path):
             return False
-        # ______________________________________________________________________
-        # tail
-        cmd = f'''export LC_ALL=""; export LANG="en_US.UTF-8"; tail -n0 -F "{args.file}"'''
-        child = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        print(f"[..] Running subprocess with PID: {child.pid}", flush=True)
-        sleep(0.5)
-        # child.poll() - Check if child process has terminated. Set and return returncode attribute.
-        if child.poll() is not None:
-            print("$ {0}\n{1}".format(cmd, child.communicate()[0]), flush=True)
-            print(f"[EE] Subprocess unexpectedly closed PID: {child.pid} RETURN: {child.returncode}", flush=True)
+    # __________________________________________________________________________
+    # The whole files once in the dry run mode (like cat), only the new lines otherwise (like tail -n0 -F).
+    # With a state file, the files resume from the checkpoint and the files unknown to it are new since then.
+    # The files matching later are new, they are read from the beginning.
+    state = {'files': {}} if args.dry_run else state_load(args.state_file)
+    if state is None:
+        return False
+    watcher = FileWatcher()
+    files, directories = fs_match_files(args.files) if not args.replay else ([], [])
+    if not all(watcher.add(x) for x in directories):
+        return False
+    followers = {x: FileFollower(x, from_end=not args.dry_run and not state['files'], state=state['files'].get(x))
+                 for x in files}
+    if args.replay:
+        print(f"[..] Replay: {args.replay} as {args.replay_as or args.replay} "
+              f"(speed: {args.replay_speed or 'max'})", flush=True)
+    else:
+        print(f"[..] Following [{len(followers)}] ({'inotify' if watcher.inotify_fd is not None else 'polling'}): "
+              f"{', '.join(followers)}", flush=True)
+    # __________________________________________________________________________
+    # The dry run mode reads the whole files once: no overload policy, it blocks
+    spill = None
+    if args.overload == 'spill' and not args.dry_run:
+        spill = SpillLog(args.spill_dir or f"{args.state_file}.spill", args.spill_max * 1024 * 1024)
+        if not spill.open():
             return False
+    backpressure = Backpressure('block' if args.dry_run else args.overload, args.sample_rate, spill)
     # ==================================================================================================================
     # ==================================================================================================================
-    # Start threads
+    # Event loop
     # ==================================================================================================================
-    signal.signal(signal.SIGINT, signal_handler_sigint)
-    signal.signal(signal.SIGTERM, signal_handler_sigint)
-    #
-    thread_reader.start()
-    thread_commander.start()
-    #
-    readline_count = 0
-    while True:
-        readline_count += 1
-        line = child.stdout.readline()  # <class 'bytes'>
-        # print(readline_count, __GLOBAL['stop'], child.poll(), line)  #### TEST
-        if __GLOBAL['stop']:
-            # __________________________________________________________________
-            # Terminate a child process, first kill all its descendants + foolproof protection !!!
-            children = list(filter(lambda x: x > 1024, ps_get_children(child.pid, recursive=True)))
-            children.sort(reverse=True)
-            if len(children) > 2:
-                print(f"[EE] Too many children at PID: {child.pid} for kill: {','.join([str(x) for x in children])}",
-                      flush=True)
-            else:
-                for pid in children:
-                    ps_kill(pid, signal.SIGINT)
-            child.kill()
-            sleep(0.1)
-            child.poll()
-            print(f"[..] Subprocess closed PID: {child.pid} RETURN: {child.returncode}", flush=True)
-            break
-        if child.poll() is not None and not line:
-            if not args.dry_run:
-                print(f"[EE] Subprocess unexpectedly closed PID: {child.pid} RETURN: {child.returncode}", flush=True)
-                __GLOBAL['return'] = False
-            break
-        # ______________________________________________________________________
-        # fast filter !!!
-        line = line.rstrip()  # <class 'bytes'>
-        if line:
-            LogQueue.put(line)
-        # sleep(0.1)  #### TEST
-    # ==================================================================================================================
-    # ==================================================================================================================
-    # Stop threads
-    # ==================================================================================================================
-    thread_reader.stop()
-    thread_commander.stop()
-    thread_reader.join()
-    thread_commander.join()
+    try:
+        asyncio.run(daemon_run(args, rules, watcher, followers, backpressure))
+    except Exception as err:
+        print(f"[!!] Exception: {type(err)}\n{''.join(traceback.format_exc())}", flush=True)
+        __GLOBAL['return'] = False
+    for follower in followers.values():
+        follower.close()
+    watcher.close()
+    if spill is not None:
+        spill.close()
+    counters_report()
     # __________________________________________________________________________
     if pid_file_path is not None:
         if not fs_rm_file(pid_file_path):
@@ -145,6 +229,133 @@ def main():
     return __GLOBAL['return']
 
 
+# ======================================================================================================================
+# Event loop
+# ======================================================================================================================
+async def daemon_run(args: argparse.Namespace, rules: list, watcher, followers: dict, backpressure):
+    # Reading, matching and the actions overlap: the main loop reads, the matching runs in an executor
+    # (a thread, or --workers processes) and the actions are subprocesses of the loop
+    loop = asyncio.get_running_loop()
+    for signum in [signal.SIGINT, signal.SIGTERM]:
+        loop.add_signal_handler(signum, lambda x=signum: (signal_handler_sigint(x, None), watcher.wake()))
+    watcher.start()
+    # __________________________________________________________________________
+    # Matcher: a batch is matched as a whole, the results are processed in the order of the batches
+    matcher_rules = [{k: x[k] for k in ['name', 'scope', 'pattern', 'regex', 'format', 'where']} for x in rules]
+    if args.workers:
+        executor = concurrent.futures.ProcessPoolExecutor(
+            args.workers, mp_context=multiprocessing.get_context('spawn'),  # No fork of the event loop
+            initializer=matcher_init, initargs=(matcher_rules, args.decode_errors, True))
+        print(f"[..] Matcher processes: {args.workers}", flush=True)
+    else:
+        executor = concurrent.futures.ThreadPoolExecutor(
+            1, thread_name_prefix="Matcher", initializer=matcher_init,
+            initargs=(matcher_rules, args.decode_errors, False))
+    results = asyncio.Queue(max(1, args.workers) * 2)  # Batches in flight
+    actions = ActionRunner(args.max_actions, args.output_limit, args.dry_run)
+    thread_metrics = None
+    if args.metrics:
+        thread_metrics = ThreadMetrics(name="ThreadMetrics", address=args.metrics,
+                                       collect=lambda: metrics_text(rules, actions, backpressure))
+        if not thread_metrics.trg_init:
+            print(f"[EE] Failed init thread: {thread_metrics.name}", flush=True)
+            __GLOBAL['return'] = False
+            executor.shutdown()
+            return
+        thread_metrics.start()
+    tasks = [asyncio.create_task(matcher_dispatch(executor, results)),
+             asyncio.create_task(matcher_collect({x['name']: x for x in rules}, results, actions))]
+    # __________________________________________________________________________
+    replay_time = time.monotonic()
+    if args.replay:
+        if not await replay_file(args.replay, args.replay_speed, args.replay_as):
+            __GLOBAL['return'] = False
+        await LogQueue.join()
+        replay_time = time.monotonic() - replay_time
+    else:
+        await daemon_follow(args, watcher, followers, backpressure)
+    # __________________________________________________________________________
+    if not args.dry_run:
+        # The lines not processed yet, queued or spilled, are read again on the next start
+        if not state_save(args.state_file, state_checkpoint(followers)):
+            __GLOBAL['return'] = False
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    executor.shutdown(wait=True, cancel_futures=True)
+    rules_flush(rules, actions)
+    await actions.wait()  # Bounded by the action timeouts
+    if thread_metrics is not None:
+        thread_metrics.stop()
+        thread_metrics.join()
+    for signum in [signal.SIGINT, signal.SIGTERM]:
+        loop.remove_signal_handler(signum)
+    if args.replay:
+        replay_report(rules, replay_time)
+
+
+async def daemon_follow(args: argparse.Namespace, watcher, followers: dict, backpressure):
+    # The followed files until stopped, or read once in the dry run mode
+    scan_time = time.monotonic()
+    checkpoint_time = time.monotonic()
+    checkpoint_lines = 0
+    report_time = time.monotonic()
+    while not __GLOBAL['stop']:
+        more = False  # A follower has more data to read: no wait
+        for path, follower in followers.items():
+            lines = follower.read()
+            if lines:
+                # ______________________________________________________________
+                # fast filter !!! one batch per read, the lines stay bytes, only the matched ones are decoded
+                await backpressure.put(path, lines, follower.checkpoint())
+                checkpoint_lines += len(lines)
+            more = more or follower.more
+        if args.metrics:  # The followers change on the event loop only: the metrics thread reads a snapshot
+            Readers['files'] = tuple((k, v.ino, v.dev, v.offset) for k, v in followers.items())
+        spilled = backpressure.replay()  # Lines left in the spill log
+        if args.dry_run:
+            if more:
+                await asyncio.sleep(0)
+                continue
+            await LogQueue.join()
+            break
+        if args.stats_interval and time.monotonic() - report_time >= args.stats_interval:
+            report_time = time.monotonic()
+            counters_report()
+        # ______________________________________________________________________
+        # checkpoint: the offsets after the last batch processed of each file (at-least-once), the reading goes on
+        if checkpoint_lines >= args.checkpoint_lines or \
+                time.monotonic() - checkpoint_time >= args.checkpoint_interval:
+            state_save(args.state_file, state_checkpoint(followers))
+            checkpoint_time = time.monotonic()
+            checkpoint_lines = 0
+        # ______________________________________________________________________
+        # new and removed files
+        if watcher.inotify_fd is not None:
+            rescan = await watcher.wait(0 if more else _SPILL_INTERVAL if spilled else _WAIT_INTERVAL)
+        else:
+            await watcher.wait(0 if more else _SPILL_INTERVAL if spilled else _POLL_INTERVAL)
+            rescan = time.monotonic() - scan_time > _RESCAN_INTERVAL
+        if rescan:
+            scan_time = time.monotonic()
+            files, directories = fs_match_files(args.files)
+            for x in directories:
+                watcher.add(x)
+            for x in set(files) - set(followers):
+                print(f"[..] Following: {x}", flush=True)
+                followers[x] = FileFollower(x, from_end=False)
+            for x in set(followers) - set(files):
+                print(f"[..] Not following: {x}", flush=True)
+                follower = followers.pop(x)
+                while True:  # The rest of the removed file
+                    lines = follower.read()
+                    if lines:
+                        await backpressure.put(x, lines, follower.checkpoint())
+                    if not follower.more:
+                        break
+                follower.close()
+
+
 # ======================================================================================================================
 # Functions
 # ======================================================================================================================
@@ -199,51 +410,368 @@ def fs_rm_file(path: str, dry_run: bool = False) -> bool:
     return True
 
 
-def ps_kill(pid: int, signum: int = 9):
-    try:
-        os.kill(pid, signum)
-    except OSError:
-        return False
-    else:
-        return True
+def fs_match_files(patterns: list) -> (list, list):
+    # The files matching the glob patterns, plain paths even if they do not exist yet, and their directories
+    files = set()
+    directories = set()
+    for x in map(os.path.abspath, patterns):
+        if glob.has_magic(x):
+            files.update(filter(os.path.isfile, glob.glob(x)))
+            directories.update(filter(os.path.isdir, glob.glob(os.path.dirname(x))))
+        else:
+            files.add(x)
+            directories.add(os.path.dirname(x))
+    # __________________________________________________________________________
+    return sorted(files), sorted(directories)
 
 
-def ps_get_pid_list():
+def yaml_load_file(path: str) -> Union[None, dict]:
+    try:
+        from ruamel.yaml import YAML
+    except ImportError:
+        print("[EE] Python module is required for --rules: ruamel.yaml", flush=True)
+        return None
+    yaml = YAML()
     try:
-        pids = [int(x) for x in os.listdir('/proc') if x.isdigit()]
-        return pids
+        with open(path, 'rt', encoding='utf-8') as f:
+            data = yaml.load(f)
     except Exception as err:
-        print("[!!] Exception :: {}\n{}".format(err, "".join(traceback.format_exc())), flush=True)
+        print(f"[!!] Exception: {type(err)}\n{''.join(traceback.format_exc(limit=1))}", flush=True)
+        return None
+    # __________________________________________________________________________
+    if data is None:
+        return dict()
+    # __________________________________________________________________________
+    return data  # <class 'ruamel.yaml.comments.CommentedMap'>
+
+
+def rules_load(path: str) -> Union[None, list]:
+    re_simple_str = re.compile(r"^([\w\-.]+)$")
+    rules_yaml = yaml_load_file(path)
+    if rules_yaml is None:
+        return None
+    rules_yaml = rules_yaml.get('rules')
+    if not isinstance(rules_yaml, list) or not rules_yaml:
+        print(f"[EE] Invalid rules file: {path}", flush=True)
         return None
+    # __________________________________________________________________________
+    rules = []
+    for item in rules_yaml:
+        if not isinstance(item, dict):
+            print(f"[EE] Invalid rule: {item}", flush=True)
+            return None
+        rule = {'name': item.get('name'),
+                'pattern': item.get('pattern'),
+                'format': item.get('format'),
+                'where': item.get('where'),
+                'action': item.get('action'),
+                'repeat_interval': item.get('repeat_interval', 60),
+                'scope': item.get('scope', '*'),
+                'concurrency': item.get('concurrency', 1),
+                'timeout': item.get('timeout', 60),
+                'debounce': item.get('debounce', 0),
+                'burst': item.get('burst', 1),
+                'sample': item.get('sample', 10),
+                'tokens': 0, 'refill': 0, 'batch': None, 'timer': None,  # Rate limit state
+                'stats': {'matches': 0, 'actions': 0, 'failures': 0, 'timeouts': 0, 'completed': 0,
+                          'seconds': 0.0, 'buckets': [0] * len(_LATENCY_BUCKETS)}}  # Read by the metrics
+        rule['tokens'] = rule['burst']
+        if not isinstance(rule['name'], str) or not re_simple_str.search(rule['name']):
+            print(f"[EE] Invalid rule name: {rule['name']}", flush=True)
+            return None
+        if rule['name'] in [x['name'] for x in rules]:
+            print(f"[EE] Duplicate rule found: {rule['name']}", flush=True)
+            return None
+        for key, types, minimum in [('pattern', (str, type(None)) if rule['where'] else str, None),
+                                    ('where', (str, type(None)), None), ('format', (str, type(None)), None),
+                                    ('action', str, None), ('scope', str, None),
+                                    ('repeat_interval', (int, float), 0), ('debounce', (int, float), 0),
+                                    ('burst', int, 1), ('sample', int, 0),
+                                    ('concurrency', int, 1), ('timeout', (int, float), 1)]:
+            if not isinstance(rule[key], types) or minimum is not None and rule[key] < minimum:
+                print(f"[EE] Invalid rule {rule['name']} {key}: {rule[key]}", flush=True)
+                return None
+        try:
+            # bytes: the lines are not decoded
+            rule['regex'] = re.compile(rule['pattern'].encode('utf-8')) if rule['pattern'] is not None else None
+        except re.error as err:
+            print(f"[EE] Invalid rule {rule['name']} pattern: {err}", flush=True)
+            return None
+        if rule['where'] is not None:
+            if rule['format'] not in _FORMATS:
+                print(f"[EE] Invalid rule {rule['name']} format: {rule['format']}, one of: {', '.join(_FORMATS)}",
+                      flush=True)
+                return None
+            try:
+                predicate_compile(rule['where'], rule['format'])
+            except (SyntaxError, ValueError) as err:
+                print(f"[EE] Invalid rule {rule['name']} where: {err}", flush=True)
+                return None
+        rule['window'] = None
+        if item.get('window') is not None:
+            rule['window'] = rule_window(rule['name'], item['window'])
+            if rule['window'] is None:
+                return None
+        rules.append(rule)
+    # __________________________________________________________________________
+    return rules
 
 
-def ps_get_ppid(pid: int) -> Union[None, int]:
+def rule_window(name: str, config: dict) -> Union[None, 'RuleWindow']:
+    if not isinstance(config, dict):
+        print(f"[EE] Invalid rule {name} window: {config}", flush=True)
+        return None
+    window = {'type': config.get('type', 'sliding'),
+              'seconds': config.get('seconds'),
+              'threshold': config.get('threshold', 0),
+              'baseline': config.get('baseline', 0),
+              'ratio': config.get('ratio', 2),
+              'key': config.get('key', ''),
+              'max_keys': config.get('max_keys', 10000)}
+    window['idle'] = config.get('idle', max(window['seconds'] or 0, window['baseline'] or 0))
+    for key, types, minimum in [('type', str, None), ('seconds', (int, float), 1), ('threshold', int, 0),
+                                ('baseline', (int, float), 0), ('ratio', (int, float), 0), ('key', str, None),
+                                ('max_keys', int, 1), ('idle', (int, float), 1)]:
+        if not isinstance(window[key], types) or minimum is not None and window[key] < minimum:
+            print(f"[EE] Invalid rule {name} window {key}: {window[key]}", flush=True)
+            return None
+    if window['type'] not in ('sliding', 'tumbling'):
+        print(f"[EE] Invalid rule {name} window type: {window['type']}", flush=True)
+        return None
+    if window['baseline'] and window['baseline'] <= window['seconds']:
+        print(f"[EE] Invalid rule {name} window baseline: {window['baseline']}, not longer than the window",
+              flush=True)
+        return None
     try:
-        f = open("/proc/{0}/status".format(pid))
-        for line in f:
-            if line.startswith("PPid:"):
-                f.close()
-                return int(line.split()[1])
-        print(f"[..] PPid not found PID: {pid}", flush=True)
-        f.close()
+        window['key'] = re.compile(window['key']) if window['key'] else None
+    except re.error as err:
+        print(f"[EE] Invalid rule {name} window key: {err}", flush=True)
+        return None
+    # __________________________________________________________________________
+    return RuleWindow(**window)
+
+
+def predicate_compile(expression: str, format: str) -> (object, list):
+    # (predicate, needles) of a field condition: comparisons of fields and constants joined by and, or, not.
+    # The needles are substrings of any line the predicate can be true for: the fields and the values
+    # required by the top-level and. Only the plain ASCII names and strings are needles, as written in any line:
+    # numbers compare as numbers (2 == 2.0 == "2"), the JSON lines may escape the other characters.
+    tree = ast.parse(expression.strip(), mode='eval').body
+    required = tree.values if isinstance(tree, ast.BoolOp) and isinstance(tree.op, ast.And) else [tree]
+    needles = set()
+    for x in required:
+        if not isinstance(x, ast.Compare):
+            continue
+        for node in [x.left] + x.comparators:
+            if isinstance(node, (ast.Name, ast.Attribute)):
+                name = predicate_field(node)[0]
+                if not _RE_PREDICATE_NEEDLE.match(name):
+                    continue
+                if format == 'json':
+                    needles.add(f'"{name}"'.encode('utf-8'))
+                elif format == 'logfmt' or name not in _RE_NGINX_COMBINED.groupindex:
+                    needles.add(f'{name}='.encode('utf-8'))  # nginx: the key=value fields after the combined ones
+        if len(x.ops) == 1 and isinstance(x.ops[0], ast.Eq):
+            for node in [x.left] + x.comparators:
+                if isinstance(node, ast.Constant) and isinstance(node.value, str) and \
+                        _RE_PREDICATE_NEEDLE.match(node.value) and not predicate_number(node.value):
+                    needles.add(node.value.encode('utf-8'))
+    # __________________________________________________________________________
+    return predicate_node(tree), sorted(needles)
+
+
+def predicate_number(value: str) -> bool:
+    try:
+        float(value)
+    except ValueError:
+        return False
+    return True
+
+
+def predicate_node(node: ast.AST):
+    if isinstance(node, ast.BoolOp):
+        parts = [predicate_node(x) for x in node.values]
+        if isinstance(node.op, ast.And):
+            return lambda f: all(x(f) for x in parts)
+        return lambda f: any(x(f) for x in parts)
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+        part = predicate_node(node.operand)
+        return lambda f: not part(f)
+    if isinstance(node, ast.Compare):
+        left = predicate_value(node.left)
+        terms = [(_PREDICATE_OPERATORS[type(op)], predicate_value(x)) for op, x in zip(node.ops, node.comparators)
+                 if type(op) in _PREDICATE_OPERATORS]
+        if len(terms) != len(node.ops):
+            raise ValueError(f"operator not allowed: {ast.unparse(node)}")
+
+        def compare(f: dict) -> bool:
+            a = left(f)
+            for op, value in terms:
+                b = value(f)
+                if not predicate_compare(op, a, b):
+                    return False
+                a = b
+            return True
+        return compare
+    if isinstance(node, (ast.Name, ast.Attribute)):
+        value = predicate_value(node)
+        return lambda f: bool(value(f))
+    raise ValueError(f"expression not allowed: {ast.unparse(node)}")
+
+
+def predicate_value(node: ast.AST):
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub) and isinstance(node.operand, ast.Constant):
+        node = ast.Constant(-node.operand.value)
+    if isinstance(node, ast.Constant):
+        return lambda f: node.value
+    if isinstance(node, (ast.Tuple, ast.List)) and all(isinstance(x, ast.Constant) for x in node.elts):
+        values = tuple(x.value for x in node.elts)
+        return lambda f: values
+    path = predicate_field(node)
+    # __________________________________________________________________________
+    return lambda f: fields_get(f, path)
+
+
+def predicate_field(node: ast.AST) -> list:
+    # The keys of a field: status, or upstream.response_time for nested JSON objects
+    if isinstance(node, ast.Name):
+        return [node.id]
+    if isinstance(node, ast.Attribute):
+        return predicate_field(node.value) + [node.attr]
+    raise ValueError(f"field or constant expected: {ast.unparse(node)}")
+
+
+def predicate_compare(op, a, b) -> bool:
+    # The text values (logfmt, nginx) compared with numbers as numbers, a missing field never matches
+    if a is None or b is None:
+        return False
+    try:
+        if isinstance(a, str) and isinstance(b, (int, float)) and not isinstance(b, bool):
+            a = float(a)
+        elif isinstance(b, str) and isinstance(a, (int, float)) and not isinstance(a, bool):
+            b = float(b)
+        elif isinstance(a, str) and isinstance(b, tuple) and b and all(isinstance(x, (int, float)) for x in b):
+            a = float(a)
+        return op(a, b)
+    except (ValueError, TypeError):
+        return False
+
+
+def fields_get(fields: dict, path: list):
+    for x in path:
+        if not isinstance(fields, dict):
+            return None
+        fields = fields.get(x)
+    return fields
+
+
+def fields_parse(format: str, line: bytes, json_loads) -> Union[None, dict]:
+    if format == 'json':
+        try:
+            fields = json_loads(line)
+        except ValueError:
+            return None
+        return fields if isinstance(fields, dict) else None
+    # __________________________________________________________________________
+    text = line.decode('utf-8', errors='replace')
+    fields = {}
+    if format == 'nginx':
+        m = _RE_NGINX_COMBINED.match(text)
+        if m is None:
+            return None
+        fields = m.groupdict()
+        text = text[m.end():]  # The key=value fields after the combined ones: rt=0.012 urt="2.001"
+    for key, value in _RE_LOGFMT.findall(text):
+        fields[key] = value[1:-1].replace('\\"', '"') if value.startswith('"') else value
+    # __________________________________________________________________________
+    return fields or None
+
+
+def json_loader():
+    # orjson if installed: several times faster than json
+    try:
+        import orjson
+    except ImportError:
+        return json.loads
+    return orjson.loads
+
+
+def rule_prefilter(rules: list) -> Union[None, re.Pattern]:
+    # One alternation of all the patterns. Non-capturing: groups make the alternation much slower in re.
+    re_global_flags = re.compile(r'^\(\?([aiLmsx]+)\)')
+    re_backref = re.compile(r'\\[1-9]|\(\?P=|\(\?\(')
+    alternatives = []
+    for x in rules:
+        if re_backref.search(x['pattern']):
+            return None  # The group numbers change in the alternation
+        m = re_global_flags.search(x['pattern'])
+        pattern = f"(?{m.group(1)}:{x['pattern'][m.end():]})" if m else x['pattern']  # Flags for this rule only
+        alternatives.append(f"(?:{pattern})")
+    try:
+        return re.compile('|'.join(alternatives).encode('utf-8'))
+    except re.error:
         return None
+
+
+def state_load(path: str) -> Union[None, dict]:
+    if not os.path.exists(path):
+        return {'files': {}}
+    try:
+        with open(path, 'rt', encoding='utf-8') as f:
+            data = json.load(f)
     except Exception as err:
-        print("[!!] Exception :: {}\n{}".format(err, "".join(traceback.format_exc())), flush=True)
+        print(f"[!!] Exception: {type(err)}\n{''.join(traceback.format_exc(limit=1))}", flush=True)
+        return None
+    # __________________________________________________________________________
+    if not isinstance(data, dict):
+        print(f"[EE] Invalid state file: {path}", flush=True)
         return None
+    data.setdefault('files', {})
+    return data
 
 
-def ps_get_children(pid: int, recursive=False):
-    process_list = [(proc_pid, ps_get_ppid(proc_pid)) for proc_pid in ps_get_pid_list()]
-    tmp = filter(lambda x: x[1] == pid, process_list)
-    result = [x[0] for x in tmp]
-    if recursive:
-        recursive_result = []
-        for x in result:
-            for y in ps_get_children(x, recursive=True):
-                recursive_result.append(y)
-        return result + recursive_result
-    else:
-        return result
+def state_save(path: str, data: dict) -> bool:
+    tmp_path = f"{path}_tmp"
+    try:
+        with open(tmp_path, 'wt', encoding='utf-8') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except Exception as err:
+        print(f"[!!] Exception: {type(err)}\n{''.join(traceback.format_exc(limit=1))}", flush=True)
+        return False
+    # __________________________________________________________________________
+    return True
+
+
+def state_checkpoint(followers: dict) -> dict:
+    return {'files': {k: Marks[k] for k in followers if k in Marks}}
+
+
+def inotify_has_created(data: bytes) -> bool:
+    # struct inotify_event: int wd, uint32 mask, uint32 cookie, uint32 len, char name[len]
+    offset = 0
+    while offset + 16 <= len(data):
+        wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+        if mask & (_IN_CREATE | _IN_MOVED_TO | _IN_Q_OVERFLOW):
+            return True
+        offset += 16 + length
+    # __________________________________________________________________________
+    return False
+
+
+def inotify_init() -> Union[None, tuple]:
+    # inotify through libc, None when not available (not Linux, no ctypes)
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    # __________________________________________________________________________
+    return libc, fd
 
 
 def human_readable_signal(signum: int) -> Union[int, str]:
@@ -254,130 +782,1005 @@ def human_readable_signal(signum: int) -> Union[int, str]:
         return signum
 
 
-def shell_exec(cmd: str, shell: str = "/bin/bash", dry_run: bool = False) -> (int, str):
+async def shell_exec(cmd: str, shell: str = "/bin/bash", dry_run: bool = False, env: dict = None, data: str = None,
+                     timeout: float = None, output_limit: int = 65536) -> (int, str):
+    # data on stdin; asyncio.TimeoutError once the process group of the command is killed
     if dry_run:
         print(f"$ {cmd}", flush=True)
         return 0, ""
-    child = subprocess.Popen(cmd,
-                             shell=True,
-                             executable=shell,
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.STDOUT,
-                             stdin=subprocess.PIPE)
-    stdout = child.communicate()[0]
-    returncode = child.returncode
+    child = await asyncio.create_subprocess_exec(shell, '-c', cmd,
+                                                 env=dict(os.environ, **env) if env else None,
+                                                 stdin=asyncio.subprocess.DEVNULL if data is None else
+                                                 asyncio.subprocess.PIPE,
+                                                 stdout=asyncio.subprocess.PIPE,
+                                                 stderr=asyncio.subprocess.STDOUT,
+                                                 start_new_session=True)  # Its own process group
+    output = bytearray()
+    size = 0
+
+    async def feed():
+        try:
+            child.stdin.write(data.encode('utf-8', errors='replace'))
+            await child.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # The command does not read it all
+        child.stdin.close()
+
+    async def communicate():
+        nonlocal size
+        feeder = asyncio.ensure_future(feed()) if data is not None else None
+        while True:
+            chunk = await child.stdout.read(65536)
+            if not chunk:
+                break
+            size += len(chunk)  # Read to the end, kept up to the limit
+            if len(output) < output_limit:
+                output.extend(chunk[:output_limit - len(output)])
+        if feeder is not None:
+            await feeder
+        await child.wait()
+    # __________________________________________________________________________
+    try:
+        await asyncio.wait_for(communicate(), timeout)
+    except asyncio.TimeoutError:
+        try:
+            os.killpg(child.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        await child.wait()
+        raise
+    stdout = output.decode("utf-8", errors="replace").strip()
+    if size > len(output):
+        stdout += f"\n... {size - len(output)} bytes more"
+    # __________________________________________________________________________
+    return child.returncode, stdout
+
+
+async def replay_file(path: str, speed: float = 0, source: str = "") -> bool:
+    # The lines of a recorded log in batches, as fast as possible or at speed times the pace of their timestamps.
+    # The lines come from the source path for the rule scopes, the recorded log by default.
+    try:
+        f = gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+    except OSError as err:
+        print(f"[EE] Failed to open: {path}\n{err}", flush=True)
+        return False
+    source = source or path
+    pending = b''
+    start, first, ts = time.monotonic(), None, None
+    with f:
+        while not __GLOBAL['stop']:
+            read_start = time.perf_counter()
+            try:
+                chunk = f.read(_READ_CHUNK)
+            except (OSError, EOFError) as err:
+                print(f"[EE] Failed to read: {path}\n{err}", flush=True)
+                return False
+            if not chunk:
+                break
+            lines = (pending + chunk).split(b'\n')
+            pending = lines.pop()
+            Stages['read'].append(time.perf_counter() - read_start)
+            if not speed:
+                await LogQueue.put((source, lines, {'queued': time.perf_counter()}))
+                continue
+            # __________________________________________________________________
+            # paced: the batch is cut where the next line is due later
+            batch = []
+            for line in lines:
+                ts = replay_timestamp(line) or ts  # A line without a timestamp goes with the previous one
+                if ts is not None:
+                    first = ts if first is None else first
+                    delay = start + (ts - first) / speed - time.monotonic()
+                    if delay > 0:
+                        if batch:
+                            await LogQueue.put((source, batch, {'queued': time.perf_counter()}))
+                            batch = []
+                        await asyncio.sleep(delay)
+                        if __GLOBAL['stop']:
+                            return True
+                batch.append(line)
+            if batch:
+                await LogQueue.put((source, batch, {'queued': time.perf_counter()}))
+    if pending:
+        await LogQueue.put((source, [pending], {'queued': time.perf_counter()}))
+    # __________________________________________________________________________
+    return True
+
+
+def replay_timestamp(line: bytes) -> Union[None, float]:
+    # Seconds, only the differences matter: the time zone is ignored
+    m = _RE_REPLAY_ISO.search(line, 0, 64)
+    if m is not None:
+        year, month, day, hour, minute, second, fraction = m.groups()
+        fraction = float(b'0.' + fraction) if fraction else 0.0
+    else:
+        m = _RE_REPLAY_CLF.search(line, 0, 128)
+        if m is None:
+            return None
+        day, month, year, hour, minute, second = m.groups()
+        month = _MONTHS.get(month)
+        fraction = 0.0
+        if month is None:
+            return None
+    try:
+        ts = datetime.datetime(int(year), int(month), int(day), int(hour), int(minute), int(second))
+    except ValueError:
+        return None
     # __________________________________________________________________________
-    return returncode, stdout.decode("utf-8").strip()
+    return (ts - datetime.datetime(1970, 1, 1)).total_seconds() + fraction
+
+
+def percentile(values: list, p: float) -> float:
+    # values sorted
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def replay_report(rules: list, elapsed: float):
+    print(f"[..] Replay: {Counters['lines']} lines in {elapsed:.3f} s: {Counters['lines'] / elapsed:.0f} lines/s, "
+          f"matching: {Counters['match_seconds']:.3f} s", flush=True)
+    print("[..] Stage latency per batch (ms): {:>8} {:>8} {:>8} {:>8} {:>8} {:>8}".format(
+        'batches', 'p50', 'p90', 'p99', 'max', 'total'), flush=True)
+    for stage, values in Stages.items():
+        values = sorted(values)
+        print("[..]   {:<31} {:>8} {:>8.3f} {:>8.3f} {:>8.3f} {:>8.3f} {:>8.0f}".format(
+            stage, len(values), *[percentile(values, x) * 1000 for x in [50, 90, 99, 100]],
+            sum(values) * 1000), flush=True)
+    # ru_maxrss: KiB on Linux, the matcher processes are children once stopped
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    rss_children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    print(f"[..] Peak RSS: {rss:.1f} MiB, children (matcher processes, actions): {rss_children:.1f} MiB", flush=True)
+    matches = ', '.join(f"{x['name']}: {x['stats']['matches']}" for x in rules)
+    print(f"[..] Matches per rule: {matches}", flush=True)
 
 
 # ======================================================================================================================
 # Classes
 # ======================================================================================================================
-class ThreadCommander(threading.Thread):
-    def __init__(self, name: str, dry_run: bool = False):
-        threading.Thread.__init__(self)
-        self.name = name
-        self.dry_run = dry_run
-        self.trg_stop = False
-        self.trg_init = False
+class FileFollower:
+    # Reads the lines appended to a file, reopens it after rotation and rereads it after truncation
+    def __init__(self, path: str, from_end: bool = True, state: dict = None):
+        self.path = path
+        self.fd = None
+        self.ino = None
+        self.dev = None
+        self.offset = 0
+        self.buffer = bytearray(_READ_CHUNK)  # Reused by every read
+        self.view = memoryview(self.buffer)
+        self.pending = b''  # The incomplete last line
+        self.more = False
+        if state is not None and self.resume(state['ino'], state['dev'], state['offset']) or \
+                self.open(from_end and state is None):
+            Marks[self.path] = self.checkpoint()
+        else:
+            print(f"[WW] File does not exist yet: {self.path}", flush=True)
+
+    def resume(self, ino: int, dev: int, offset: int) -> bool:
+        # The file of the checkpoint: still in place, or rotated away in the same directory, caught up first
+        directory = os.path.dirname(self.path)
+        try:
+            candidates = [self.path] + sorted(x.path for x in os.scandir(directory)
+                                              if x.inode() == ino and x.path != self.path)
+        except OSError:
+            candidates = [self.path]
+        for x in candidates:
+            try:
+                fd = os.open(x, os.O_RDONLY | os.O_CLOEXEC)
+            except OSError:
+                continue
+            st = os.fstat(fd)
+            if (st.st_ino, st.st_dev) != (ino, dev):
+                os.close(fd)
+                continue
+            if st.st_size < offset:
+                print(f"[WW] File truncated since the checkpoint: {x}", flush=True)
+                offset = 0
+            if x != self.path:
+                print(f"[..] File rotated since the checkpoint, catching up: {x}", flush=True)
+            self.fd, self.ino, self.dev = fd, ino, dev
+            self.offset = os.lseek(fd, offset, os.SEEK_SET)
+            self.pending = b''
+            return True
+        print(f"[WW] File of the checkpoint not found, reading from the beginning: {self.path}", flush=True)
         # ______________________________________________________________________
-        self.trg_init = True
+        return False
 
-    def run(self):
-        print(f"[..] Thread starting: {self.name} ...", flush=True)
-        # heartbit = 1
+    def checkpoint(self) -> dict:
+        # The offset of the first incomplete line
+        return {'ino': self.ino, 'dev': self.dev, 'offset': self.offset - len(self.pending)}
+
+    def open(self, from_end: bool = False) -> bool:
+        try:
+            fd = os.open(self.path, os.O_RDONLY | os.O_CLOEXEC)
+        except FileNotFoundError:
+            return False
+        except OSError as err:
+            print(f"[EE] Failed to open: {self.path}\n{err}", flush=True)
+            return False
+        st = os.fstat(fd)
+        self.fd, self.ino, self.dev = fd, st.st_ino, st.st_dev
+        self.offset = os.lseek(fd, 0, os.SEEK_END) if from_end else 0
+        self.pending = b''
+        # ______________________________________________________________________
+        return True
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def read(self) -> list:
+        # The complete lines of one chunk
+        if self.fd is None:
+            if not self.open():
+                return []
+            Marks[self.path] = self.checkpoint()
+            print(f"[..] File opened: {self.path}", flush=True)
+        lines = self.read_fd()
+        if self.more:
+            return lines  # Rotation and truncation are checked at the end of the data
+        # ______________________________________________________________________
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return lines  # Rotated away and not created yet: keep the old file
+        if (st.st_ino, st.st_dev) != (self.ino, self.dev):
+            # The old file is read to the end above, its last line may have no newline
+            print(f"[..] File rotated: {self.path}", flush=True)
+            if self.pending:
+                lines.append(self.pending)
+            self.close()
+            if self.open():
+                lines += self.read_fd()
+        elif st.st_size < self.offset:
+            # truncate or copytruncate: the new content starts from the beginning
+            print(f"[..] File truncated: {self.path}", flush=True)
+            self.offset = os.lseek(self.fd, 0, os.SEEK_SET)
+            self.pending = b''
+            lines += self.read_fd()
+        # ______________________________________________________________________
+        return lines
+
+    def read_fd(self) -> list:
+        # One chunk at most, self.more tells whether the buffer was filled up
+        self.more = False
+        try:
+            n = os.readv(self.fd, [self.view])
+        except OSError as err:
+            print(f"[EE] Failed to read: {self.path}\n{err}", flush=True)
+            return []
+        if n == 0:
+            return []
+        self.offset += n
+        self.more = n == len(self.buffer)
+        # One copy out of the buffer and one split per chunk, not per line
+        chunk = self.pending + self.view[:n] if self.pending else self.view[:n].tobytes()
+        lines = chunk.split(b'\n')
+        self.pending = lines.pop()
+        # ______________________________________________________________________
+        return lines
+
+
+class FileWatcher:
+    # Waits for changes in the directories of the followed files: inotify, or polling as a fallback
+    def __init__(self):
+        inotify = inotify_init()
+        self.libc, self.inotify_fd = inotify if inotify is not None else (None, None)
+        self.directories = set()
+        self.event = None  # Set by inotify or wake()
+        self.created = False
+
+    def add(self, directory: str) -> bool:
+        if self.inotify_fd is None or directory in self.directories:
+            return True
+        mask = _IN_MODIFY | _IN_ATTRIB | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE
+        if self.libc.inotify_add_watch(self.inotify_fd, directory.encode(), mask) < 0:
+            print(f"[EE] Failed to watch: {directory}\n{os.strerror(ctypes.get_errno())}", flush=True)
+            return False
+        self.directories.add(directory)
+        # ______________________________________________________________________
+        return True
+
+    def start(self):
+        # In the event loop: the inotify events are read by the loop
+        self.event = asyncio.Event()
+        if self.inotify_fd is not None:
+            asyncio.get_running_loop().add_reader(self.inotify_fd, self.read_events)
+
+    def read_events(self):
+        try:
+            while True:
+                data = os.read(self.inotify_fd, 65536)  # The modifications are not needed, the files are read anyway
+                if not data:
+                    break
+                if not self.created:
+                    self.created = inotify_has_created(data)
+        except BlockingIOError:
+            pass
+        self.event.set()
+
+    def wake(self):
+        self.event.set()
+
+    async def wait(self, timeout: float) -> bool:
+        # True if a file was created or moved into a watched directory
+        if timeout:
+            try:
+                await asyncio.wait_for(self.event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        else:
+            await asyncio.sleep(0)  # The other tasks and the inotify reader run
+        self.event.clear()
+        created, self.created = self.created, False
+        # ______________________________________________________________________
+        return created
+
+    def close(self):
+        if self.inotify_fd is not None:
+            os.close(self.inotify_fd)
+            self.inotify_fd = None
+
+
+class RuleWindow:
+    # The matches of a rule per key counted in a ring of fixed-width buckets: the memory per key is bounded
+    # whatever the rate. The keys are bounded by max_keys and evicted once idle, least recently matched first.
+    def __init__(self, type: str, seconds: float, threshold: int, baseline: float, ratio: float,
+                 key: Union[None, re.Pattern], max_keys: int, idle: float):
+        self.type = type
+        self.seconds = seconds
+        self.threshold = threshold
+        self.baseline = baseline
+        self.ratio = ratio
+        self.key = key
+        self.max_keys = max_keys
+        self.idle = idle
+        self.window_buckets = _WINDOW_BUCKETS if type == 'sliding' else 1
+        self.width = seconds / self.window_buckets
+        self.size = max(self.window_buckets, math.ceil(baseline / self.width))  # The baseline includes the window
+        self.keys = collections.OrderedDict()  # key: [counts, bucket index, above threshold, last match, first]
+        self.evicted = 0
+
+    def key_of(self, line: str) -> str:
+        if self.key is None:
+            return ''
+        m = self.key.search(line)
+        if m is None:
+            return ''
+        return m.group(1) if self.key.groups else m.group(0)
+
+    def add(self, key: str, now: float) -> Union[None, int]:
+        # The count of the window when the threshold is crossed, None otherwise
+        index = int(now // self.width)
+        state = self.keys.get(key)
+        if state is None:
+            state = self.keys[key] = [array.array('L', [0]) * self.size, index, False, now, now]
+            if len(self.keys) > self.max_keys:
+                self.keys.popitem(last=False)
+                self.evicted += 1
+        else:
+            self.keys.move_to_end(key)
+            self.advance(state, index)
+        counts = state[0]
+        counts[index % self.size] += 1
+        state[3] = now
+        self.evict(now)
+        # ______________________________________________________________________
+        count = sum(counts[(index - i) % self.size] for i in range(self.window_buckets))
+        fired = count > self.threshold
+        if fired and self.baseline:
+            # The rate of the window against the rate of the rest of the baseline, once it is known
+            base_buckets = self.size - self.window_buckets
+            base = sum(counts) - count
+            fired = now - state[4] >= self.baseline and \
+                count / self.window_buckets >= self.ratio * base / base_buckets
+        if not fired:
+            state[2] = False
+            return None
+        if state[2]:
+            return None  # Above the threshold already: fired on the crossing
+        state[2] = True
+        # ______________________________________________________________________
+        return count
+
+    def advance(self, state: list, index: int):
+        # The buckets passed since the last match are cleared
+        gap = index - state[1]
+        if gap <= 0:
+            return
+        if gap >= self.size:
+            state[0] = array.array('L', [0]) * self.size
+        else:
+            for i in range(1, gap + 1):
+                state[0][(state[1] + i) % self.size] = 0
+        if self.type == 'tumbling' or gap >= self.window_buckets:
+            state[2] = False  # A new window
+        state[1] = index
+
+    def evict(self, now: float):
+        while self.keys:
+            key, state = next(iter(self.keys.items()))
+            if now - state[3] <= self.idle:
+                break
+            del self.keys[key]
+            self.evicted += 1
+
+
+class SpillLog:
+    # The batches on disk, replayed in order: segment files of records (meta length, data length, meta: path
+    # and offsets as JSON, lines joined), each removed once replayed. The read offsets saved stay behind
+    # the spilled lines, the segments left by the last run are not needed: the lines are read again.
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segments = []  # Closed segments to replay
+        self.size = 0  # Bytes not replayed yet
+        self.sequence = 0
+        self.writer = None
+        self.writer_size = 0
+        self.reader = None
+
+    def open(self) -> bool:
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            for x in glob.glob(os.path.join(self.directory, '*.seg')):
+                os.remove(x)
+        except OSError as err:
+            print(f"[EE] Failed to open the spill log: {self.directory}\n{err}", flush=True)
+            return False
+        # ______________________________________________________________________
+        return True
+
+    @property
+    def empty(self) -> bool:
+        return self.size == 0
+
+    def write(self, path: str, lines: list, mark: dict) -> bool:
+        # False when the spill log is full
+        meta = json.dumps([path, mark]).encode('utf-8')
+        data = b'\n'.join(lines)
+        if self.size and self.size + len(data) > self.max_bytes:
+            return False
+        if self.writer is None or self.writer_size >= _SPILL_SEGMENT:
+            self.rotate()
+            self.writer = open(os.path.join(self.directory, f"{self.sequence:08d}.seg"), 'wb')
+            self.writer_size = 0
+            self.sequence += 1
+        self.writer.write(struct.pack('!II', len(meta), len(data)))
+        self.writer.write(meta)
+        self.writer.write(data)
+        size = 8 + len(meta) + len(data)
+        self.writer_size += size
+        self.size += size
+        # ______________________________________________________________________
+        return True
+
+    def rotate(self):
+        # The segment written becomes a segment to replay
+        if self.writer is not None:
+            self.writer.close()
+            self.segments.append(self.writer.name)
+            self.writer = None
+
+    def read(self) -> Union[None, tuple]:
+        # (path, lines, offsets) of the oldest record, None when empty
         while True:
-            # heartbit += 1
-            # print(f"::{self.name}:: Heartbit: {heartbit}", flush=True)  #### TEST
-            # __________________________________________________________________
-            if self.trg_stop:
-                return
-            # __________________________________________________________________
+            if self.reader is None:
+                if not self.segments:
+                    if self.writer is None:
+                        return None
+                    self.rotate()
+                self.reader = open(self.segments.pop(0), 'rb')
+            header = self.reader.read(8)
+            if header:
+                meta_length, data_length = struct.unpack('!II', header)
+                path, mark = json.loads(self.reader.read(meta_length))
+                data = self.reader.read(data_length)
+                self.size -= 8 + meta_length + data_length
+                return path, data.split(b'\n'), mark
+            self.reader.close()
+            fs_rm_file(self.reader.name)
+            self.reader = None
+
+    def close(self):
+        for x in [self.writer, self.reader]:
+            if x is not None:
+                x.close()
+                fs_rm_file(x.name)
+        for x in self.segments:
+            fs_rm_file(x)
+
+
+class Backpressure:
+    # The overload policy when LogQueue is full: block the reading, drop the oldest batches, keep 1 line
+    # in N from 3/4 full on (the batches are dropped while full), or spill the batches to disk. Once spilling,
+    # all the batches go through the spill log, replayed in order while the queue is less than half full:
+    # the lines of a file keep their order.
+    def __init__(self, policy: str, sample_rate: int = 10, spill: SpillLog = None):
+        self.policy = policy
+        self.sample_rate = sample_rate
+        self.spill = spill
+
+    async def put(self, path: str, lines: list, mark: dict):
+        if self.spill is not None and (LogQueue.full() or not self.spill.empty):
+            while not self.spill.write(path, lines, mark):  # Full: the reading blocks until the replay catches up
+                self.replay()
+                await asyncio.sleep(_SPILL_INTERVAL)
+            Counters['spilled'] += len(lines)
+            return
+        if LogQueue.full() and self.policy == 'drop-oldest':
+            while LogQueue.full():
+                dropped = LogQueue.get_nowait()[1]
+                LogQueue.task_done()
+                Counters['dropped'] += len(dropped)
+        elif self.policy == 'sample' and LogQueue.qsize() >= LogQueue.maxsize * 3 // 4:
+            kept = lines[::self.sample_rate]
+            Counters['dropped'] += len(lines) - len(kept)
             try:
-                cmd = CmdQueue.get(timeout=1)  # Blocking if timeout not set
-                CmdQueue.task_done()
-            except queue.Empty:
+                LogQueue.put_nowait((path, kept, mark))
+            except asyncio.QueueFull:  # Never blocks the reading: the sampled lines are dropped too
+                Counters['dropped'] += len(kept)
+            return
+        # ______________________________________________________________________
+        await LogQueue.put((path, lines, mark))
+
+    def replay(self) -> bool:
+        # True while lines are left in the spill log
+        if self.spill is None:
+            return False
+        while not self.spill.empty and LogQueue.qsize() < LogQueue.maxsize // 2:
+            batch = self.spill.read()
+            if batch is None:
+                break
+            LogQueue.put_nowait(batch)
+        # ______________________________________________________________________
+        return not self.spill.empty
+
+
+class RuleSet:
+    # The rules in scope of a file are prefiltered by one combined regex: a line is scanned once whatever
+    # the rule count, and the full regex of the rules runs only on the lines it matches. The field
+    # conditions run on the lines containing their needles only, each line parsed once per format.
+    def __init__(self, rules: list):
+        self.rules = rules
+        self.scopes = {}  # path: (prefilter, regex rules, field rules)
+        self.predicates = {}  # rule name: (predicate, needles)
+        for x in rules:
+            if x['where'] is not None:
+                self.predicates[x['name']] = predicate_compile(x['where'], x['format'])
+        self.json_loads = json_loader()
+
+    def match(self, path: str, line: bytes, counters: dict) -> list:
+        scope = self.scopes.get(path)
+        if scope is None:
+            scope = self.scopes[path] = self.compile(path)
+        prefilter, rules, field_rules = scope
+        matched = []
+        if rules and (prefilter is None or prefilter.search(line) is not None):
+            matched = [x for x in rules if x['regex'].search(line)]
+        if field_rules:
+            matched += [x for x in field_rules if all(y in line for y in self.predicates[x['name']][1])]
+        if not matched or not self.predicates:
+            return matched
+        # ______________________________________________________________________
+        fields = {}  # format: parsed fields
+        result = []
+        for x in matched:
+            if x['where'] is None:
+                result.append(x)
                 continue
-            # __________________________________________________________________
+            predicate, needles = self.predicates[x['name']]
+            if x['regex'] is not None and not all(y in line for y in needles):
+                continue  # The needles of the field rules are checked above
+            if x['format'] not in fields:
+                fields[x['format']] = fields_parse(x['format'], line, self.json_loads)
+                counters['parsed' if fields[x['format']] is not None else 'parse_errors'] += 1
+            if fields[x['format']] is not None and predicate(fields[x['format']]):
+                result.append(x)
+        # ______________________________________________________________________
+        return result
+
+    def compile(self, path: str) -> tuple:
+        rules = [x for x in self.rules if fnmatch.fnmatchcase(path, x['scope'])]
+        field_rules = [x for x in rules if x['regex'] is None]  # Field conditions only
+        rules = [x for x in rules if x['regex'] is not None]
+        prefilter = rule_prefilter(rules) if rules else None
+        if rules and prefilter is None:
+            print(f"[WW] Rules not combined, matched one by one: {path}", flush=True)
+        # ______________________________________________________________________
+        return prefilter, rules, field_rules
+
+
+class ActionRunner:
+    # The actions run concurrently as subprocesses of the event loop, each rule up to its concurrency
+    # and all rules up to --max-actions, killed after the timeout of their rule
+    def __init__(self, max_actions: int, output_limit: int, dry_run: bool = False):
+        self.slots = asyncio.Semaphore(max_actions)
+        self.rule_slots = {}  # rule name: semaphore
+        self.output_limit = output_limit
+        self.dry_run = dry_run
+        self.tasks = set()  # Started or waiting for a slot
+
+    def submit(self, rule: dict, env: dict, data: str = None) -> bool:
+        if len(self.tasks) >= _ACTIONS_PENDING_MAX:
+            Counters['actions_dropped'] += 1
+            print(f"[WW] Action dropped, {len(self.tasks)} pending: {rule['name']}", flush=True)
+            return False
+        task = asyncio.create_task(self.run(rule, env, data))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        # ______________________________________________________________________
+        return True
+
+    async def run(self, rule: dict, env: dict, data: str = None):
+        rule_slots = self.rule_slots.get(rule['name'])
+        if rule_slots is None:
+            rule_slots = self.rule_slots[rule['name']] = asyncio.Semaphore(rule['concurrency'])
+        stats = rule['stats']
+        async with rule_slots, self.slots:
+            Counters['actions'] += 1
+            stats['actions'] += 1
             start_dt = datetime.datetime.now()
-            rc, rd = shell_exec(cmd, dry_run=self.dry_run)
+            try:
+                rc, rd = await shell_exec(rule['action'], dry_run=self.dry_run, env=env, data=data,
+                                          timeout=rule['timeout'], output_limit=self.output_limit)
+            except asyncio.TimeoutError:
+                Counters['actions_timeout'] += 1
+                stats['timeouts'] += 1
+                print("[EE] Shell TIMEOUT: {0} RULE: {1}\n{2}\n{3}\n{2}".format(
+                    rule['timeout'], rule['name'], "-  " * 33 + "-", rule['action']), flush=True)
+                return
+            except Exception as err:
+                Counters['actions_failed'] += 1
+                stats['failures'] += 1
+                print(f"[!!] Exception: {type(err)}\n{''.join(traceback.format_exc(limit=1))}", flush=True)
+                return
             duration = datetime.datetime.now() - start_dt
-            if rc != 0:
-                print("[EE] Shell EXIT: {0} DURATION: {1}\n{2}\n{3}\n{4}\n{2}".format(
-                    rc, duration, "-  " * 33 + "-", cmd, rd), flush=True)
-            else:
-                print("[OK] Shell EXIT: {0} DURATION: {1}\n{2}\n{3}\n{4}\n{2}".format(
-                    rc, duration, "-  " * 33 + "-", cmd, rd), flush=True)
-            # __________________________________________________________________
-            sleep(1)
+        # ______________________________________________________________________
+        seconds = duration.total_seconds()
+        stats['seconds'] += seconds
+        stats['completed'] += 1
+        for i, x in enumerate(_LATENCY_BUCKETS):
+            if seconds <= x:
+                stats['buckets'][i] += 1
+                break
+        if rc != 0:
+            Counters['actions_failed'] += 1
+            stats['failures'] += 1
+            print("[EE] Shell EXIT: {0} DURATION: {1}\n{2}\n{3}\n{4}\n{2}".format(
+                rc, duration, "-  " * 33 + "-", rule['action'], rd), flush=True)
+        else:
+            print("[OK] Shell EXIT: {0} DURATION: {1}\n{2}\n{3}\n{4}\n{2}".format(
+                rc, duration, "-  " * 33 + "-", rule['action'], rd), flush=True)
+
+    async def wait(self):
+        while self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
 
-    def stop(self):
-        print(f"[..] Thread stopping: {self.name} ...", flush=True)
-        self.trg_stop = True
 
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    collect = None  # Set by ThreadMetrics: returns the metrics text
 
-class ThreadReader(threading.Thread):
-    def __init__(self, name: str, dry_run: bool = False):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        try:
+            body = self.collect().encode('utf-8')
+        except Exception as err:
+            print(f"[!!] Exception: {type(err)}\n{''.join(traceback.format_exc(limit=1))}", flush=True)
+            self.send_error(500)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # No log line per scrape
+
+
+class MetricsUnixServer(socketserver.UnixStreamServer):
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ('', 0)  # No client address on a Unix socket
+
+
+class ThreadMetrics(threading.Thread):
+    # Serves the metrics: the counters are read as they are, the event loop is not locked nor waited for
+    def __init__(self, name: str, address: str, collect):
         threading.Thread.__init__(self)
         self.name = name
-        self.dry_run = dry_run
-        self.trg_stop = False
+        self.address = address
+        self.server = None
         self.trg_init = False
+        handler = type('MetricsHandler', (MetricsHandler,), {'collect': staticmethod(collect)})
+        try:
+            if '/' in address:
+                if os.path.exists(address) and stat.S_ISSOCK(os.stat(address).st_mode):
+                    os.remove(address)  # Left by the last run
+                self.server = MetricsUnixServer(address, handler)
+            else:
+                host, _, port = address.rpartition(':')
+                self.server = http.server.HTTPServer((host or '127.0.0.1', int(port)), handler)
+        except (OSError, ValueError) as err:
+            print(f"[EE] Failed to listen for the metrics: {address}\n{err}", flush=True)
+            return
         # ______________________________________________________________________
         self.trg_init = True
 
     def run(self):
-        print(f"[..] Thread starting: {self.name} ...", flush=True)
-        # heartbit = 0
-        while True:
-            # heartbit += 1
-            # print(f"::{self.name}:: Heartbit: {heartbit}", flush=True)  #### TEST
-            # __________________________________________________________________
-            if self.trg_stop:
-                return
-            # __________________________________________________________________
-            try:
-                line = LogQueue.get(timeout=1)  # Blocking if timeout not set
-                LogQueue.task_done()
-            except queue.Empty:
-                line = None
-            # __________________________________________________________________
-            if line is not None:
-                # Processing
-                processing_action_1(line.decode('utf-8'))
+        print(f"[..] Thread starting: {self.name}: {self.address} ...", flush=True)
+        self.server.serve_forever(poll_interval=0.5)
 
     def stop(self):
         print(f"[..] Thread stopping: {self.name} ...", flush=True)
-        self.trg_stop = True
+        self.server.shutdown()
+        self.server.server_close()
+        if '/' in self.address:
+            fs_rm_file(self.address)
 
 
 # ======================================================================================================================
 # Processing
 # ======================================================================================================================
-def processing_action_1(line: str):
+def match_batch(rules: RuleSet, path: str, lines: list, decode_errors: str, counters: dict) -> list:
+    # [(matched rules, decoded line)]
+    matches = []
+    for line in lines:
+        line = line.rstrip()  # CR of CRLF logs, trailing blanks: '$' anchors at the end of the text
+        if not line:
+            continue
+        counters['lines'] += 1
+        matched = rules.match(path, line, counters)
+        if not matched:
+            counters['skipped'] += 1
+            continue
+        try:
+            text = line.decode('utf-8', errors=decode_errors)
+        except UnicodeDecodeError as err:
+            counters['decode_errors'] += 1
+            print(f"[WW] Line skipped: {path}: {err}", flush=True)
+            continue
+        counters['decoded'] += 1
+        matches.append((matched, text))
     # __________________________________________________________________________
-    if not re_log_entry_1.search(line):
-        # print(f"IGNORE: {line}")  #### TEST
-        return
+    return matches
+
+
+def matcher_init(rules: list, decode_errors: str, process: bool):
+    # Executor initializer: the rules stay in the matcher thread or process, only the batches are passed
+    if process:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)  # Stopped by the main process
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    _MATCHER['rules'] = RuleSet(rules)
+    _MATCHER['decode_errors'] = decode_errors
+
+
+def matcher_batch(path: str, lines: list) -> (list, dict):
+    # In the executor: [(matched rule names, decoded line)] and the counters of the batch
+    start = time.perf_counter()
+    counters = {'lines': 0, 'decoded': 0, 'skipped': 0, 'decode_errors': 0, 'parsed': 0, 'parse_errors': 0}
+    matches = match_batch(_MATCHER['rules'], path, lines, _MATCHER['decode_errors'], counters)
+    counters['match_seconds'] = time.perf_counter() - start
     # __________________________________________________________________________
-    if (datetime.datetime.now() - action_1_buffer['last']).seconds < action_1_repeat_interval:
-        # print(f"TIMEOUT: action_1")  #### TEST
-        return
+    return [([x['name'] for x in y[0]], y[1]) for y in matches], counters
+
+
+async def matcher_dispatch(executor: concurrent.futures.Executor, results: asyncio.Queue):
+    loop = asyncio.get_running_loop()
+    while True:
+        path, lines, mark = await LogQueue.get()
+        if Stages:
+            Stages['queue'].append(time.perf_counter() - mark['queued'])
+        await results.put((path, mark, loop.run_in_executor(executor, matcher_batch, path, lines)))
+
+
+async def matcher_collect(rules: dict, results: asyncio.Queue, actions: ActionRunner):
+    # The results in the order of the batches: the lines of a file keep their order
+    while True:
+        path, mark, future = await results.get()
+        try:
+            matches, counters = await future
+        except Exception as err:
+            print(f"[!!] Exception: {type(err)}\n{''.join(traceback.format_exc(limit=1))}", flush=True)
+            matches, counters = [], {}
+        start = time.perf_counter()
+        for key, value in counters.items():
+            Counters[key] += value
+        for names, text in matches:
+            processing_rules([rules[x] for x in names], path, text, actions)
+        if Stages:
+            Stages['match'].append(counters.get('match_seconds', 0))
+            Stages['process'].append(time.perf_counter() - start)
+            Stages['total'].append(time.perf_counter() - mark['queued'])
+        Marks[path] = mark  # After the processing: saved by the next checkpoint
+        LogQueue.task_done()
+
+
+def metrics_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def metrics_text(rules: list, actions: ActionRunner, backpressure) -> str:
+    # Prometheus text format, from the metrics thread: the lines/s is the rate of the lines counter
+    lines = []
+
+    def metric(name: str, kind: str, help_text: str, samples: list):
+        lines.append(f"# HELP {_METRICS_PREFIX}_{name} {help_text}")
+        lines.append(f"# TYPE {_METRICS_PREFIX}_{name} {kind}")
+        for labels, value in samples:
+            labels = ','.join(f'{k}="{metrics_label(v)}"' for k, v in labels.items())
+            lines.append(f"{_METRICS_PREFIX}_{name}{{{labels}}} {value}" if labels else
+                         f"{_METRICS_PREFIX}_{name} {value}")
+    # __________________________________________________________________________
+    for key, help_text in [('lines', "Lines read"), ('decoded', "Matched lines decoded"),
+                           ('skipped', "Lines matching no rule"), ('decode_errors', "Matched lines not decoded"),
+                           ('parsed', "Lines parsed for the field conditions"),
+                           ('parse_errors', "Lines not parsed for the field conditions"),
+                           ('match_seconds', "Seconds spent matching, by all the matchers"),
+                           ('dropped', "Lines dropped by the overload policy"),
+                           ('spilled', "Lines spilled to disk by the overload policy"),
+                           ('coalesced', "Matches added to a pending batch"), ('actions', "Actions started"),
+                           ('actions_failed', "Actions failed"), ('actions_timeout', "Actions killed on timeout"),
+                           ('actions_dropped', "Actions dropped, too many pending")]:
+        metric(f"{key}_total", 'counter', help_text, [({}, Counters[key])])
+    metric('queue_batches', 'gauge', "Batches in the queue of the matcher", [({}, LogQueue.qsize())])
+    metric('queue_batches_max', 'gauge', "Size of the queue of the matcher", [({}, LogQueue.maxsize)])
+    metric('spill_bytes', 'gauge', "Bytes in the spill log",
+           [({}, backpressure.spill.size if backpressure.spill is not None else 0)])
+    metric('actions_pending', 'gauge', "Actions running or waiting for a slot", [({}, len(actions.tasks))])
     # __________________________________________________________________________
-    # print("TODO: action_1")  #### TEST
-    CmdQueue.put(action_1_cmd)
-    action_1_buffer['last'] = datetime.datetime.now()
+    lag = []
+    for path, ino, dev, offset in Readers['files']:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        if (st.st_ino, st.st_dev) == (ino, dev):
+            lag.append(({'file': path}, max(0, st.st_size - offset)))
+    metric('reader_lag_bytes', 'gauge', "Bytes of the file not read yet", lag)
+    # __________________________________________________________________________
+    metric('rule_matches_total', 'counter', "Lines matched by the rule",
+           [({'rule': x['name']}, x['stats']['matches']) for x in rules])
+    metric('rule_actions_total', 'counter', "Actions of the rule started",
+           [({'rule': x['name']}, x['stats']['actions']) for x in rules])
+    metric('rule_action_failures_total', 'counter', "Actions of the rule failed",
+           [({'rule': x['name']}, x['stats']['failures']) for x in rules])
+    metric('rule_action_timeouts_total', 'counter', "Actions of the rule killed on timeout",
+           [({'rule': x['name']}, x['stats']['timeouts']) for x in rules])
+    windows = [x for x in rules if x['window'] is not None]
+    metric('rule_window_keys', 'gauge', "Keys of the window of the rule",
+           [({'rule': x['name']}, len(x['window'].keys)) for x in windows])
+    metric('rule_window_evicted_total', 'counter', "Keys of the window of the rule evicted",
+           [({'rule': x['name']}, x['window'].evicted) for x in windows])
+    metric('rule_action_duration_seconds', 'histogram', "Duration of the actions of the rule completed", [])
+    for x in rules:
+        stats = x['stats']
+        name = f"{_METRICS_PREFIX}_rule_action_duration_seconds"
+        label = f'rule="{metrics_label(x["name"])}"'
+        cumulative = 0
+        for le, count in zip(_LATENCY_BUCKETS, list(stats['buckets'])):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{label},le="{le}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{label},le="+Inf"}} {stats["completed"]}')
+        lines.append(f'{name}_sum{{{label}}} {stats["seconds"]}')
+        lines.append(f'{name}_count{{{label}}} {stats["completed"]}')
+    # __________________________________________________________________________
+    return '\n'.join(lines) + '\n'
+
+
+def counters_report():
+    print("[..] Lines: {lines}, decoded: {decoded}, skipped: {skipped}, decode errors: {decode_errors}, "
+          "parsed: {parsed}, parse errors: {parse_errors}, dropped: {dropped}, spilled: {spilled}; "
+          "coalesced: {coalesced}, actions: {actions}, failed: {actions_failed}, timeout: {actions_timeout}, "
+          "dropped: {actions_dropped}".format(**Counters), flush=True)
+
+
+def processing_rules(rules: list, path: str, line: str, actions: ActionRunner):
+    # The matches of a rule are aggregated into one batch, handed over to one action as soon as the rule allows
+    now = time.monotonic()
+    now_dt = datetime.datetime.now()
+    for rule in rules:
+        rule['stats']['matches'] += 1
+        key, count = None, None
+        if rule['window'] is not None:
+            # Only the crossings of the window threshold are triggers
+            key = rule['window'].key_of(line)
+            count = rule['window'].add(key, now)
+            if count is None:
+                continue
+        batch = rule['batch']
+        if batch is None:
+            batch = rule['batch'] = {'file': path, 'count': 0, 'first': now_dt, 'first_time': now, 'sample': [],
+                                     'keys': {}}
+        else:
+            Counters['coalesced'] += 1
+        if key is not None:
+            batch['keys'][key] = count  # Every key crossing in the batch, with its latest count
+        batch['count'] += 1
+        batch['last'] = now_dt
+        batch['last_time'] = now
+        if len(batch['sample']) < rule['sample']:
+            batch['sample'].append(line)
+        if rule['timer'] is None:
+            rule_batch_check(rule, actions)
     # __________________________________________________________________________
     return
 
 
+def rule_batch_due(rule: dict, now: float) -> float:
+    # Seconds before the batch can be handed over: a token of the bucket (burst tokens, one more every
+    # repeat_interval seconds) and the rule quiet for debounce seconds, a storm held repeat_interval at most
+    batch = rule['batch']
+    due = 0.0
+    if rule['repeat_interval']:
+        rule['tokens'] = min(rule['burst'], rule['tokens'] + (now - rule['refill']) / rule['repeat_interval'])
+        rule['refill'] = now
+        due = (1 - rule['tokens']) * rule['repeat_interval']
+    if rule['debounce']:
+        deadline = batch['first_time'] + max(rule['debounce'], rule['repeat_interval'])
+        due = max(due, min(batch['last_time'] + rule['debounce'], deadline) - now)
+    # __________________________________________________________________________
+    return due
+
+
+def rule_batch_check(rule: dict, actions: ActionRunner):
+    # On the first match of a batch, then on a timer until it is due
+    rule['timer'] = None
+    if rule['batch'] is None:
+        return
+    due = rule_batch_due(rule, time.monotonic())
+    if due > 0:
+        rule['timer'] = asyncio.get_running_loop().call_later(due, rule_batch_check, rule, actions)
+        return
+    rule_batch_flush(rule, actions)
+
+
+def rule_batch_flush(rule: dict, actions: ActionRunner):
+    # One action for the batch: its details in the environment, the sample lines on stdin
+    batch, rule['batch'] = rule['batch'], None
+    if rule['timer'] is not None:
+        rule['timer'].cancel()
+        rule['timer'] = None
+    rule['tokens'] -= 1
+    env = {'LOG_EVENT_FILE': batch['file'],
+           'LOG_EVENT_RULE': rule['name'],
+           'LOG_EVENT_LINE': batch['sample'][0] if batch['sample'] else '',
+           'LOG_EVENT_COUNT': str(batch['count']),
+           'LOG_EVENT_FIRST': batch['first'].isoformat(timespec='milliseconds'),
+           'LOG_EVENT_LAST': batch['last'].isoformat(timespec='milliseconds')}
+    if batch['keys']:
+        key, count = next(iter(batch['keys'].items()))
+        env['LOG_EVENT_KEY'] = key
+        env['LOG_EVENT_WINDOW_COUNT'] = str(count)
+        env['LOG_EVENT_KEY_COUNT'] = str(len(batch['keys']))
+        keys, size = [], 0
+        for key, count in batch['keys'].items():
+            size += len(key.encode()) + len(str(count)) + 2
+            if size > _WINDOW_KEYS_ENV_MAX:
+                break
+            keys.append(f"{count} {key}")
+        env['LOG_EVENT_KEYS'] = '\n'.join(keys)
+    actions.submit(rule, env, ''.join(x + '\n' for x in batch['sample']))
+
+
+def rules_flush(rules: list, actions: ActionRunner):
+    # On stop: the pending batches are handed over whatever the limits
+    for rule in rules:
+        if rule['batch'] is not None:
+            rule_batch_flush(rule, actions)
+
+
 # ======================================================================================================================
 # Signal Handlers
 # ======================================================================================================================
 # noinspection PyShadowingNames
 def signal_handler_sigint(signum, frame):
     print(f"\n[..] Received signal: {human_readable_signal(signum)}", flush=True)
-    __GLOBAL['stop']: True
+    __GLOBAL['stop'] = True
 
 
 # %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
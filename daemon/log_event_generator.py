@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# ----------------------------------------------------------------------------------------------------------------------
+import argparse
+import datetime
+import gzip
+import json
+import random
+import sys
+import traceback
+from typing import Union
+
+_FORMATS = ['plain', 'json', 'nginx']
+_PATHS = ['/', '/api/v1/orders', '/api/v1/users', '/static/app.js', '/health', '/login']
+_AGENTS = ['curl/8.5.0', 'Mozilla/5.0 (X11; Linux x86_64)', 'python-requests/2.31.0']
+
+
+def main():
+    # __________________________________________________________________________
+    # command-line options, arguments
+    try:
+        parser = argparse.ArgumentParser(
+            description='Synthetic log lines to benchmark log_event_daemon.py --replay.')
+        parser.add_argument('-o', '--output', action='store', type=str, default="",
+                            metavar="", help="output file, compressed if ending with .gz (default: stdout)")
+        parser.add_argument('-n', '--lines', action='store', type=int, default=1000000,
+                            metavar="", help="number of lines (default: %(default)s)")
+        parser.add_argument('--format', action='store', type=str, default='plain', choices=_FORMATS,
+                            help="plain: nginx error log, json: one object per line, nginx: combined access log "
+                                 "(default: %(default)s)")
+        parser.add_argument('--rate', action='store', type=float, default=1000,
+                            metavar="", help="lines per second of the timestamps (default: %(default)s)")
+        parser.add_argument('--start', action='store', type=str, default="",
+                            metavar="", help="timestamp of the first line, ISO 8601 (default: now)")
+        parser.add_argument('--error-ratio', action='store', type=float, default=0.001,
+                            metavar="", help="ratio of the upstream timeout lines, 5xx statuses (default: %(default)s)")
+        parser.add_argument('--keys', action='store', type=int, default=16,
+                            metavar="", help="number of distinct upstreams (default: %(default)s)")
+        parser.add_argument('--seed', action='store', type=int, default=0,
+                            metavar="", help="random seed, the same output for the same options (default: %(default)s)")
+        args = parser.parse_args()  # <class 'argparse.Namespace'>
+    except SystemExit:
+        return False
+    # __________________________________________________________________________
+    if args.lines < 0 or args.rate <= 0 or not 0 <= args.error_ratio <= 1 or args.keys < 1:
+        print("[EE] Invalid --lines, --rate, --error-ratio or --keys value", file=sys.stderr, flush=True)
+        return False
+    try:
+        start = datetime.datetime.fromisoformat(args.start) if args.start else datetime.datetime.now()
+    except ValueError:
+        print(f"[EE] Invalid --start timestamp: {args.start}", file=sys.stderr, flush=True)
+        return False
+    # __________________________________________________________________________
+    try:
+        if not args.output:
+            f = sys.stdout.buffer
+        elif args.output.endswith('.gz'):
+            f = gzip.open(args.output, 'wb', compresslevel=6)
+        else:
+            f = open(args.output, 'wb')
+        try:
+            log_generate(f, args, start)
+        finally:
+            if f is not sys.stdout.buffer:
+                f.close()
+    except BrokenPipeError:
+        return True  # e.g. | head
+    except Exception as err:
+        print(f"[!!] Exception: {type(err)}\n{''.join(traceback.format_exc(limit=1))}", file=sys.stderr, flush=True)
+        return False
+    # __________________________________________________________________________
+    return True
+
+
+def log_generate(f, args: argparse.Namespace, start: datetime.datetime):
+    rnd = random.Random(args.seed)
+    upstreams = [f"http://10.0.{x // 256}.{x % 256}:8080" for x in range(args.keys)]
+    buffer = []
+    for i in range(args.lines):
+        ts = start + datetime.timedelta(seconds=i / args.rate)
+        error = rnd.random() < args.error_ratio
+        buffer.append(log_line(args.format, rnd, ts, i, error, rnd.choice(upstreams)))
+        if len(buffer) >= 10000:
+            f.write(''.join(buffer).encode())
+            buffer = []
+    f.write(''.join(buffer).encode())
+
+
+def log_line(format: str, rnd: random.Random, ts: datetime.datetime, i: int, error: bool,
+             upstream: str) -> Union[None, str]:
+    path = rnd.choice(_PATHS)
+    client = f"192.168.{rnd.randrange(256)}.{rnd.randrange(1, 255)}"
+    status = rnd.choice([502, 504]) if error else rnd.choice([200, 200, 200, 200, 301, 304, 404])
+    if format == 'plain':
+        if error:
+            return (f"{ts:%Y/%m/%d %H:%M:%S} [error] 1234#0: *{i} upstream timed out (110: Connection timed out) "
+                    f"while reading response header from upstream, client: {client}, server: example.org, "
+                    f"request: \"GET {path} HTTP/1.1\", upstream: \"{upstream}{path}\", host: \"example.org\"\n")
+        return (f"{ts:%Y/%m/%d %H:%M:%S} [info] 1234#0: *{i} client {client} closed keepalive connection, "
+                f"request: \"GET {path} HTTP/1.1\"\n")
+    if format == 'json':
+        return json.dumps({'time': ts.isoformat(timespec='milliseconds'), 'level': 'error' if error else 'info',
+                           'method': 'GET', 'path': path, 'status': status, 'upstream': upstream,
+                           'duration_ms': rnd.randrange(60000, 61000) if error else rnd.randrange(1, 500),
+                           'client': client, 'message': "upstream timed out" if error else "request done"}) + '\n'
+    if format == 'nginx':
+        return (f"{client} - - [{ts:%d/%b/%Y:%H:%M:%S} +0000] \"GET {path} HTTP/1.1\" {status} "
+                f"{0 if error else rnd.randrange(100, 50000)} \"-\" \"{rnd.choice(_AGENTS)}\"\n")
+    return None
+
+
+# %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+if __name__ == '__main__':
+    # __________________________________________________________________________
+    sys.exit(not main())  # Compatible return code
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# ----------------------------------------------------------------------------------------------------------------------
+# python3 -m unittest discover -s daemon
+import importlib.util
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+_spec = importlib.util.spec_from_file_location(
+    'log_event_daemon', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'log_event_daemon.py'))
+log_event_daemon = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(log_event_daemon)
+
+_RULES = '''
+rules:
+  - name: "flood"
+    pattern: 'upstream timed out'
+    action: 'true'
+    repeat_interval: 60
+    debounce: 10
+    window: {seconds: 60, threshold: 5, key: 'upstream: "([^"]+)"'}
+'''
+
+
+class Actions:
+    # ActionRunner stand-in: the submitted environments
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, rule: dict, env: dict, data: str):
+        self.submitted.append(env)
+
+
+class TestWindowKeys(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        with tempfile.NamedTemporaryFile('wt', suffix=".yaml", delete=False) as f:
+            f.write(_RULES)
+        self.addCleanup(os.remove, f.name)
+        self.rules = log_event_daemon.rules_load(f.name)
+        if self.rules is None:
+            self.skipTest("ruamel.yaml is not installed")
+
+    def crossings(self, keys: int, actions: Actions):
+        # 6 matches per key: each key crosses the threshold of 5 within the same debounce interval
+        for i in range(6):
+            for key in range(keys):
+                log_event_daemon.processing_rules(
+                    self.rules, '/var/log/nginx/error.log',
+                    f'upstream timed out, upstream: "http://10.0.0.{key}:8080"', actions)
+
+    async def test_keys_crossing_in_one_interval(self):
+        actions = Actions()
+        self.crossings(16, actions)
+        self.assertEqual(actions.submitted, [])  # Held by the debounce
+        log_event_daemon.rules_flush(self.rules, actions)
+        self.assertEqual(len(actions.submitted), 1)
+        env = actions.submitted[0]
+        self.assertEqual(env['LOG_EVENT_COUNT'], '16')
+        self.assertEqual(env['LOG_EVENT_KEY_COUNT'], '16')
+        self.assertEqual(env['LOG_EVENT_KEY'], 'http://10.0.0.0:8080')
+        self.assertEqual(env['LOG_EVENT_WINDOW_COUNT'], '6')
+        self.assertEqual(env['LOG_EVENT_KEYS'].split('\n'), [f"6 http://10.0.0.{x}:8080" for x in range(16)])
+
+    async def test_keys_env_limit(self):
+        actions = Actions()
+        with mock.patch.object(log_event_daemon, '_WINDOW_KEYS_ENV_MAX', 100):
+            self.crossings(16, actions)
+            log_event_daemon.rules_flush(self.rules, actions)
+        env = actions.submitted[0]
+        self.assertEqual(env['LOG_EVENT_KEY_COUNT'], '16')
+        # 23 bytes per key: '6 http://10.0.0.0:8080' and the separator
+        self.assertEqual(len(env['LOG_EVENT_KEYS'].split('\n')), 4)
+
+
+class TestPredicateNeedles(unittest.TestCase):
+    def assertMatches(self, expression: str, fields: dict, line: bytes):
+        predicate, needles = log_event_daemon.predicate_compile(expression, 'json')
+        self.assertTrue(predicate(fields))
+        self.assertTrue(all(x in line for x in needles), needles)
+
+    def test_numbers(self):
+        self.assertMatches('duration == 2.0', {'duration': 2}, b'{"duration": 2}')
+        self.assertMatches('duration == "2.0"', {'duration': 2}, b'{"duration": 2}')
+
+    def test_escaped_strings(self):
+        self.assertMatches('message == "café"', {'message': "café"}, b'{"message": "caf\\u00e9"}')
+        self.assertMatches('path == "/api/v1"', {'path': "/api/v1"}, b'{"path": "\\/api\\/v1"}')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,16 +2,28 @@
 # -*- coding: utf-8 -*-
 # ----------------------------------------------------------------------------------------------------------------------
 import argparse
+import collections
+import concurrent.futures
+import datetime
+import fnmatch
 import os
+import re
 import sys
 import textwrap
+import time
 import traceback
+from typing import Union
 
 import psycopg2
 import psycopg2.extras
 
+_LOCK_NOTICE_TAG = "pg_alter_owner"
+_LOCK_BACKOFF_START = 1  # Seconds, doubled on every retry
+_LOCK_REPORT_MIN_MS = 10  # Lock waits reported per object from this value
+
 
 def main():
+    re_db_pattern = re.compile(r'[,*?\[]')
     # __________________________________________________________________________
     # command-line options, arguments
     try:
@@ -30,172 +42,281 @@ def main():
         parser.add_argument('--password', action='store', type=str,
                             default=os.getenv('PGPASSWORD'),
                             metavar='', help="database user password (PGPASSWORD)")
-        parser.add_argument('dbname', action='store', type=str,
-                            metavar='<DBNAME>', help="database name")
+        parser.add_argument('dbname', action='store', type=str, nargs='?', default="",
+                            metavar='<DBNAME>', help="database name, comma separated list or '*' pattern")
         parser.add_argument('role', action='store', type=str,
                             metavar='<ROLE>', help="new owner role")
+        parser.add_argument('--batch-size', action='store', type=int, default=500,
+                            metavar='', help="statements sent per round trip and transaction, default: 500")
+        parser.add_argument('--single-transaction', action='store_true',
+                            help="commit all the chunks at once at the end")
+        parser.add_argument('--lock-timeout', action='store', type=int, default=0,
+                            metavar='', help="lock wait limit per statement in ms, retry later on timeout, "
+                                             "default: 0 (wait forever)")
+        parser.add_argument('--lock-retries', action='store', type=int, default=5,
+                            metavar='', help="retries of the timed out statements with --lock-timeout, default: 5")
+        parser.add_argument('--all', action='store_true',
+                            help="all databases of the cluster, except templates")
+        parser.add_argument('--jobs', action='store', type=int, default=4,
+                            metavar='', help="databases processed at the same time, default: 4")
+        parser.add_argument('--maintenance-db', action='store', type=str, default="postgres",
+                            metavar='', help="database to list the databases from, default: postgres")
         parser.add_argument('-n', '--dry-run', action='store_true',
                             help="testing mode with no changes made")
         args = parser.parse_args()
     except SystemExit:
         return False
     # ------------------------------------------------------------------------------------------------------------------
+    if args.batch_size < 1 or args.jobs < 1 or args.lock_timeout < 0 or args.lock_retries < 0:
+        print("[EE] Invalid --batch-size, --jobs, --lock-timeout or --lock-retries value", flush=True)
+        return False
+    if args.lock_timeout and args.single_transaction:
+        print("[EE] --lock-timeout is not compatible with --single-transaction", flush=True)
+        return False
+    if bool(args.dbname) == args.all:
+        print("[EE] Specify either <DBNAME> or --all", flush=True)
+        return False
     if args.dry_run:
         print("[WW] DRY RUN MODE", flush=True)
     # ==================================================================================================================
     # ==================================================================================================================
     # Start
     # ==================================================================================================================
+    if args.dbname and not re_db_pattern.search(args.dbname):
+        databases = [args.dbname]
+    else:
+        databases = pg_get_databases(args, args.dbname.split(',') if args.dbname else ['*'])
+        if databases is None:
+            return False
+        if not databases:
+            print(f"[EE] No databases found: {args.dbname or '--all'}", flush=True)
+            return False
+    # __________________________________________________________________________
+    if len(databases) == 1:
+        return alter_owner_database(args, databases[0], verbose=True)['result']
+    # __________________________________________________________________________
+    print(f"[..] Databases [{len(databases)}], jobs: {args.jobs}", flush=True)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        summaries = list(executor.map(lambda a: alter_owner_database(args, a, verbose=False), databases))
+    # ==================================================================================================================
+    # ==================================================================================================================
+    # End
+    # ==================================================================================================================
+    cw = max([len('DATABASE')] + [len(x['db']) for x in summaries])
+    print("[--] {}".format('-' * 95), flush=True)
+    print(f"[..] {'DATABASE'.ljust(cw)}  {'CHANGED':>8}  {'SKIPPED':>8}  {'FAILED':>8}  DURATION", flush=True)
+    for x in summaries:
+        print("[{}] {}  {:>8}  {:>8}  {:>8}  {}".format(
+            'OK' if x['result'] else 'EE', x['db'].ljust(cw), x['changed'], x['skipped'], x['failed'],
+            str(x['duration']).split('.')[0]), flush=True)
+    print("[..] {}  {:>8}  {:>8}  {:>8}".format(
+        'TOTAL'.ljust(cw), sum(x['changed'] for x in summaries), sum(x['skipped'] for x in summaries),
+        sum(x['failed'] for x in summaries)), flush=True)
+    # __________________________________________________________________________
+    return all(x['result'] for x in summaries)
+
+
+def alter_owner_database(args: argparse.Namespace, dbname: str, verbose: bool = True) -> dict:
+    summary = {'db': dbname, 'result': False, 'changed': 0, 'skipped': 0, 'failed': 0,
+               'duration': datetime.timedelta()}
+    prefix = "" if verbose else f"{dbname} | "
+    start_dt = datetime.datetime.now()
     try:
         pg_conn = psycopg2.connect(host=args.host,
                                    port=args.port,
                                    user=args.username,
                                    password=args.password,
-                                   database=args.dbname,
+                                   database=dbname,
                                    connect_timeout=10)
     except (psycopg2.OperationalError, psycopg2.ProgrammingError) as err:
-        print(f"[EE] Postgres Exception :: {type(err)}\n{str(err).strip()}", flush=True)
-        return None
+        print(f"{prefix}[EE] Postgres Exception :: {type(err)}\n{str(err).strip()}", flush=True)
+        return summary
     except Exception as err:
-        print(f"[!!] Exception: {type(err)}\n{''.join(traceback.format_exc(limit=1))}", flush=True)
-        return None
-    print(f"[OK] Postgres successfully connected: {args.dbname}", flush=True)
-    # __________________________________________________________________________
-    # database
-    _sql = '''SELECT pg_catalog.pg_authid.rolname FROM pg_catalog.pg_authid
-    JOIN pg_catalog.pg_database ON pg_catalog.pg_authid.oid = pg_catalog.pg_database.datdba
-    WHERE pg_catalog.pg_database.datname = current_database();'''
-    owner = psql(pg_conn, _sql)
-    if owner is None:
-        return False
-    if not owner:
-        owner = [("?????",)]
-    print("[--] {}".format('-' * 95), flush=True)
-    print(f"[..] Change of database owner ...", flush=True)
-    _sql = '''ALTER DATABASE "{}" OWNER TO "{}";'''.format(args.dbname, args.role)
-    print(f"\t{_sql.ljust(110)}   # {owner[0][0]} -> {args.role}", flush=True)
-    if not args.dry_run:
-        _tmp = psql(pg_conn, _sql)
-        if _tmp is None:
-            return False
+        print(f"{prefix}[!!] Exception: {type(err)}\n{''.join(traceback.format_exc(limit=1))}", flush=True)
+        return summary
+    print(f"{prefix}[OK] Postgres successfully connected: {dbname}", flush=True)
+    try:
+        summary.update(alter_owner_objects(args, pg_conn, prefix, verbose))
+    finally:
+        pg_conn.close()
+    summary['duration'] = datetime.datetime.now() - start_dt
     # __________________________________________________________________________
-    # schemas
-    _sql = '''SELECT DISTINCT "schema_name", "schema_owner" FROM information_schema.schemata 
-    WHERE NOT "schema_name" IN ('pg_catalog', 'information_schema', 'pg_toast')
-    ORDER BY "schema_name";'''
-    schemas = psql(pg_conn, _sql)
-    if schemas is None:
-        return False
-    print("[--] {}".format('-' * 95), flush=True)
-    print("[..] Change of schemas owner [{}] ...".format(len(schemas)), flush=True)
-    for x in schemas:
-        _sql = '''ALTER SCHEMA "{}" OWNER TO "{}";'''.format(x[0], args.role)
-        print(f"\t{_sql.ljust(110)}   # {x[1]} -> {args.role}", flush=True)
-        if not args.dry_run:
-            _tmp = psql(pg_conn, _sql)
-            if _tmp is None:
-                return False
-    # __________________________________________________________________________
-    # tables
-    _sql = '''SELECT schemaname, tablename, tableowner FROM pg_tables
-    WHERE NOT schemaname IN ('pg_catalog', 'information_schema', 'pg_toast')
-    ORDER BY schemaname, tablename;'''
-    tables = psql(pg_conn, _sql)
-    if tables is None:
-        return tables
-    print("[--] {}".format('-' * 95), flush=True)
-    print("[..] Change of tables owner [{}] ...".format(len(tables)), flush=True)
-    for x in tables:
-        _sql = '''ALTER TABLE "{}"."{}" OWNER TO "{}";'''.format(x[0], x[1], args.role)
-        print(f"\t{_sql.ljust(110)}   # {x[2]} -> {args.role}", flush=True)
-        if not args.dry_run:
-            _tmp = psql(pg_conn, _sql)
-            if _tmp is None:
-                return False
-    # __________________________________________________________________________
-    # sequences
-    _sql = textwrap.dedent('''
-        SELECT 
-          n.nspname as sequence_schema,
-          c.relname as sequence_name, 
-          r.rolname as sequence_owner
-        FROM pg_class c
-        JOIN pg_roles r ON r.oid = c.relowner
-        JOIN pg_namespace n ON n.oid = c.relnamespace
-        WHERE c.relkind = 'S'
-          AND n.nspname NOT IN ('pg_catalog', 'information_schema', 'pg_toast')
-        ORDER BY n.nspname, c.relname;
-    ''').strip()
-    sequences = psql(pg_conn, _sql)
-    if sequences is None:
-        return False
-    print("[--] {}".format('-' * 95), flush=True)
-    print("[..] Change of sequences owner [{}] ...".format(len(sequences)), flush=True)
-    for x in sequences:
-        _sql = '''ALTER SEQUENCE "{}"."{}" OWNER TO "{}";'''.format(x[0], x[1], args.role)
-        print(f"\t{_sql.ljust(110)}   # {x[2]} -> {args.role}", flush=True)
-        if not args.dry_run:
-            _tmp = psql(pg_conn, _sql)
-            if _tmp is None:
-                return False
-    # __________________________________________________________________________
-    # views
-    _sql = textwrap.dedent('''
-        SELECT 
-          n.nspname as view_schema,
-          c.relname as view_name, 
-          r.rolname as view_owner
-        FROM pg_class c
-        JOIN pg_roles r ON r.oid = c.relowner
-        JOIN pg_namespace n ON n.oid = c.relnamespace
-        WHERE c.relkind = 'v'
-          AND n.nspname NOT IN ('pg_catalog', 'information_schema', 'pg_toast')
-        ORDER BY n.nspname, c.relname;
-    ''').strip()
-    views = psql(pg_conn, _sql)
-    if views is None:
-        return False
-    print("[--] {}".format('-' * 95), flush=True)
-    print("[..] Change of views owner [{}] ...".format(len(views)), flush=True)
-    for x in views:
-        _sql = '''ALTER VIEW "{}"."{}" OWNER TO "{}";'''.format(x[0], x[1], args.role)
-        print(f"\t{_sql.ljust(110)}   # {x[2]} -> {args.role}", flush=True)
-        if not args.dry_run:
-            _tmp = psql(pg_conn, _sql)
-            if _tmp is None:
-                return False
-    # __________________________________________________________________________
-    # materialized views
+    return summary
+
+
+def alter_owner_objects(args: argparse.Namespace, pg_conn, prefix: str, verbose: bool) -> dict:
+    result = {'result': False}
+    # __________________________________________________________________________
+    # role
+    role = psql(pg_conn, "SELECT quote_ident(rolname), rolsuper FROM pg_catalog.pg_roles WHERE rolname = %(role)s;",
+                {'role': args.role})
+    if role is None:
+        return result
+    if not role:
+        print(f"{prefix}[EE] Role does not exist: {args.role}", flush=True)
+        return result
+    role, role_super = role[0]
+    # __________________________________________________________________________
+    # objects
+    # One catalog query for all the objects whose owner differs from the role, in execution order.
+    # Sequences linked to a table (serial, identity) cannot be changed on their own, they follow their table:
+    # a changed table carries them, a table already owned by the role is switched to their owner and back.
+    # Within a kind the least active relations go first, hot tables are locked last.
+    # Extension members are left to the extension, array and row types follow their element type and table.
+    # Large objects come as oid ranges of --batch-size objects: <first oid> <last oid>, count in place of the owner.
     _sql = textwrap.dedent('''
-        SELECT 
-          n.nspname as materialized_view_schema,
-          c.relname as materialized_view_name, 
-          r.rolname as materialized_view_owner
-        FROM pg_class c
-        JOIN pg_roles r ON r.oid = c.relowner
-        JOIN pg_namespace n ON n.oid = c.relnamespace
-        WHERE c.relkind = 'm'
-          AND n.nspname NOT IN ('pg_catalog', 'information_schema', 'pg_toast')
-        ORDER BY n.nspname, c.relname;
+        WITH target AS (SELECT oid FROM pg_catalog.pg_roles WHERE rolname = %(role)s),
+        objects AS (
+          SELECT 0 AS ord, 'DATABASE' AS kind, format('%%I', d.datname) AS ident, d.datdba AS owner_oid,
+            0::bigint AS activity
+          FROM pg_catalog.pg_database d
+          WHERE d.datname = current_database()
+          UNION ALL
+          SELECT 1, 'SCHEMA', format('%%I', n.nspname), n.nspowner, 0
+          FROM pg_catalog.pg_namespace n
+          WHERE n.nspname NOT IN ('pg_catalog', 'information_schema', 'pg_toast')
+            AND n.nspname !~ '^pg_(toast_)?temp_'
+          UNION ALL
+          SELECT CASE c.relkind WHEN 'S' THEN 3 WHEN 'v' THEN 4 WHEN 'm' THEN 5 WHEN 'f' THEN 6 ELSE 2 END,
+            CASE c.relkind WHEN 'S' THEN 'SEQUENCE' WHEN 'v' THEN 'VIEW' WHEN 'm' THEN 'MATERIALIZED VIEW'
+              WHEN 'f' THEN 'FOREIGN TABLE' ELSE 'TABLE' END,
+            format('%%I.%%I', n.nspname, c.relname), c.relowner,
+            coalesce(st.seq_scan, 0) + coalesce(st.idx_scan, 0)
+              + coalesce(st.n_tup_ins + st.n_tup_upd + st.n_tup_del, 0)
+          FROM pg_catalog.pg_class c
+          JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+          LEFT JOIN pg_catalog.pg_stat_all_tables st ON st.relid = c.oid
+          WHERE c.relkind IN ('r', 'p', 'S', 'v', 'm', 'f')
+            AND n.nspname NOT IN ('pg_catalog', 'information_schema', 'pg_toast')
+            AND n.nspname !~ '^pg_(toast_)?temp_'
+            AND NOT EXISTS (SELECT 1 FROM pg_catalog.pg_depend dep
+              WHERE dep.classid = 'pg_catalog.pg_class'::regclass AND dep.objid = c.oid AND dep.deptype = 'e')
+            AND NOT (c.relkind = 'S' AND EXISTS (
+              SELECT 1 FROM pg_catalog.pg_depend dep
+              WHERE dep.classid = 'pg_catalog.pg_class'::regclass AND dep.objid = c.oid
+                AND dep.refclassid = 'pg_catalog.pg_class'::regclass AND dep.deptype IN ('a', 'i')))
+          UNION ALL
+          SELECT CASE t.typtype WHEN 'd' THEN 8 ELSE 7 END, CASE t.typtype WHEN 'd' THEN 'DOMAIN' ELSE 'TYPE' END,
+            format('%%I.%%I', n.nspname, t.typname), t.typowner, 0
+          FROM pg_catalog.pg_type t
+          JOIN pg_catalog.pg_namespace n ON n.oid = t.typnamespace
+          LEFT JOIN pg_catalog.pg_class c ON c.oid = t.typrelid
+          WHERE t.typtype IN ('b', 'c', 'd', 'e', 'r') AND (t.typrelid = 0 OR c.relkind = 'c')
+            AND n.nspname NOT IN ('pg_catalog', 'information_schema', 'pg_toast')
+            AND n.nspname !~ '^pg_(toast_)?temp_'
+            AND NOT EXISTS (SELECT 1 FROM pg_catalog.pg_type e WHERE e.typarray = t.oid)
+            AND NOT EXISTS (SELECT 1 FROM pg_catalog.pg_depend dep
+              WHERE dep.classid = 'pg_catalog.pg_type'::regclass AND dep.objid = t.oid AND dep.deptype = 'e')
+          UNION ALL
+          SELECT CASE p.prokind WHEN 'p' THEN 10 WHEN 'a' THEN 11 ELSE 9 END,
+            CASE p.prokind WHEN 'p' THEN 'PROCEDURE' WHEN 'a' THEN 'AGGREGATE' ELSE 'FUNCTION' END,
+            format('%%I.%%I(%%s)', n.nspname, p.proname, pg_catalog.pg_get_function_identity_arguments(p.oid)),
+            p.proowner, 0
+          FROM pg_catalog.pg_proc p
+          JOIN pg_catalog.pg_namespace n ON n.oid = p.pronamespace
+          WHERE n.nspname NOT IN ('pg_catalog', 'information_schema', 'pg_toast')
+            AND n.nspname !~ '^pg_(toast_)?temp_'
+            AND NOT EXISTS (SELECT 1 FROM pg_catalog.pg_depend dep
+              WHERE dep.classid = 'pg_catalog.pg_proc'::regclass AND dep.objid = p.oid AND dep.deptype = 'e')
+          UNION ALL
+          SELECT 12, 'EVENT TRIGGER', format('%%I', e.evtname), e.evtowner, 0
+          FROM pg_catalog.pg_event_trigger e
+          WHERE NOT EXISTS (SELECT 1 FROM pg_catalog.pg_depend dep
+            WHERE dep.classid = 'pg_catalog.pg_event_trigger'::regclass AND dep.objid = e.oid AND dep.deptype = 'e')
+        )
+        SELECT ord, kind, ident, pg_catalog.pg_get_userbyid(owner_oid), activity FROM objects
+        WHERE owner_oid <> (SELECT oid FROM target)
+        UNION ALL
+        SELECT 2, 'LINKED SEQUENCE', format('%%I.%%I', n.nspname, t.relname),
+          quote_ident(pg_catalog.pg_get_userbyid(min(s.relowner))), 0
+        FROM pg_catalog.pg_class s
+        JOIN pg_catalog.pg_depend dep ON dep.classid = 'pg_catalog.pg_class'::regclass AND dep.objid = s.oid
+          AND dep.refclassid = 'pg_catalog.pg_class'::regclass AND dep.deptype IN ('a', 'i')
+        JOIN pg_catalog.pg_class t ON t.oid = dep.refobjid
+        JOIN pg_catalog.pg_namespace n ON n.oid = t.relnamespace
+        WHERE s.relkind = 'S' AND t.relowner = (SELECT oid FROM target) AND s.relowner <> (SELECT oid FROM target)
+        GROUP BY n.nspname, t.relname
+        UNION ALL
+        SELECT 13, 'LARGE OBJECT', min(oid)::text || ' ' || max(oid)::text, count(*)::text, min(oid)::bigint
+        FROM (
+          SELECT l.oid, (row_number() OVER (ORDER BY l.oid) - 1) / %(batch_size)s AS chunk
+          FROM pg_catalog.pg_largeobject_metadata l
+          WHERE l.lomowner <> (SELECT oid FROM target)
+        ) lo GROUP BY chunk
+        UNION ALL
+        SELECT 99, 'SKIPPED', NULL, ((SELECT count(*) FROM objects WHERE owner_oid = (SELECT oid FROM target))
+          + (SELECT count(*) FROM pg_catalog.pg_largeobject_metadata WHERE lomowner = (SELECT oid FROM target)))::text,
+          0
+        ORDER BY 1, 5, 3;
     ''').strip()
-    views = psql(pg_conn, _sql)
-    if views is None:
-        return False
-    print("[--] {}".format('-' * 95), flush=True)
-    print("[..] Change of materialized views owner [{}] ...".format(len(views)), flush=True)
-    for x in views:
-        _sql = '''ALTER MATERIALIZED VIEW "{}"."{}" OWNER TO "{}";'''.format(x[0], x[1], args.role)
-        print(f"\t{_sql.ljust(110)}   # {x[2]} -> {args.role}", flush=True)
-        if not args.dry_run:
-            _tmp = psql(pg_conn, _sql)
-            if _tmp is None:
-                return False
-    # ==================================================================================================================
-    # ==================================================================================================================
-    # End
-    # ==================================================================================================================
+    objects = psql(pg_conn, _sql, {'role': args.role, 'batch_size': args.batch_size})
+    if objects is None:
+        return result
+    result['skipped'] = int(objects.pop()[3])
+    # Only a superuser can own an event trigger
+    event_triggers = [] if role_super else list(filter(lambda a: a[1] == 'EVENT TRIGGER', objects))
+    if event_triggers:
+        objects = list(filter(lambda a: a[1] != 'EVENT TRIGGER', objects))
+        print(f"{prefix}[WW] Not a superuser, event triggers skipped [{len(event_triggers)}]: "
+              f"{', '.join(x[2] for x in event_triggers)}", flush=True)
     # __________________________________________________________________________
-    return True
+    statements = []
+    for kind in ['DATABASE', 'SCHEMA', 'TABLE', 'LINKED SEQUENCE', 'SEQUENCE', 'VIEW', 'MATERIALIZED VIEW',
+                 'FOREIGN TABLE', 'TYPE', 'DOMAIN', 'FUNCTION', 'PROCEDURE', 'AGGREGATE', 'EVENT TRIGGER',
+                 'LARGE OBJECT']:
+        group = list(filter(lambda a: a[1] == kind, objects))
+        if kind == 'LARGE OBJECT':
+            if verbose:
+                print("[--] {}".format('-' * 95), flush=True)
+                print("[..] Change of large objects owner [{}] in chunks [{}] ...".format(
+                    sum(int(x[3]) for x in group), len(group)), flush=True)
+            for x in group:
+                first, last = x[2].split()
+                statements.append(pg_large_objects_block(first, last, role))
+                if verbose:
+                    print(f"\tLARGE OBJECT {first} .. {last}   # {x[3]} -> {args.role}", flush=True)
+            continue
+        if verbose:
+            print("[--] {}".format('-' * 95), flush=True)
+            print("[..] Change of {} owner [{}] ...".format(
+                'database' if kind == 'DATABASE' else kind.lower() + 's', len(group)), flush=True)
+        for x in group:
+            if kind == 'LINKED SEQUENCE':
+                # One statement: the table is never left with the other owner between two chunks
+                _sql = '''ALTER TABLE {0} OWNER TO {1}; ALTER TABLE {0} OWNER TO {2};'''.format(
+                    x[2], x[3], role)
+            else:
+                _sql = '''ALTER {} {} OWNER TO {};'''.format(kind, x[2], role)
+            statements.append(_sql)
+            if verbose:
+                print(f"\t{_sql.ljust(110)}   # {x[3]} -> {args.role}", flush=True)
+    if verbose:
+        print("[--] {}".format('-' * 95), flush=True)
+    print(f"{prefix}[..] Already owned by {args.role}, skipped: {result['skipped']}", flush=True)
+    result['skipped'] += len(event_triggers)
+    if not statements:
+        print(f"{prefix}[OK] Nothing to do", flush=True)
+        result['result'] = True
+        return result
+    # __________________________________________________________________________
+    # execution
+    print("{}[..] Executing [{}] in chunks of {}{}{} ...".format(
+        prefix, len(statements), args.batch_size, ", single transaction" if args.single_transaction else "",
+        f", lock timeout {args.lock_timeout} ms" if args.lock_timeout else ""), flush=True)
+    if args.dry_run:
+        result['result'] = True
+        return result
+    if args.lock_timeout:
+        result['result'], result['changed'], result['failed'], timed_out, waits = pg_execute_batches_lock_aware(
+            pg_conn, statements, args.batch_size, args.lock_timeout, args.lock_retries, prefix)
+        pg_report_lock_waits(statements, timed_out, waits, prefix)
+    else:
+        result['result'], result['changed'], result['failed'] = pg_execute_batches(
+            pg_conn, statements, args.batch_size, args.single_transaction, prefix)
+    if result['result']:
+        print(f"{prefix}[OK] Done: {result['changed']} statements", flush=True)
+    # __________________________________________________________________________
+    return result
 
 
 # ======================================================================================================================
@@ -205,10 +326,10 @@ def argparse_required_or_environment(key, default=None):
     return {'default': os.getenv(key, default)} if os.getenv(key, default) else {'required': True}
 
 
-def pg_query(conn, query):
+def pg_query(conn, query, params=None):
     cursor = conn.cursor()
     try:
-        cursor.execute(query)
+        cursor.execute(query, params)
     except (psycopg2.DataError, psycopg2.ProgrammingError) as err:
         print(f"[EE] Postgres Exception :: {type(err)}\n{str(err).strip()}", flush=True)
         conn.rollback()
@@ -223,8 +344,204 @@ def pg_query(conn, query):
     return cursor  # <class 'psycopg2.extensions.cursor'>
 
 
-def psql(conn, query: str):
-    cursor = pg_query(conn, query)
+def pg_execute_chunk(conn, statements: list, commit: bool = True) -> bool:
+    # One round trip: the statements are sent together as a single simple query
+    cursor = conn.cursor()
+    try:
+        cursor.execute('\n'.join(statements))
+    except psycopg2.Error:
+        conn.rollback()
+        cursor.close()
+        return False
+    except Exception as err:
+        print(f"[!!] Exception: {type(err)}\n{''.join(traceback.format_exc(limit=1))}", flush=True)
+        conn.rollback()
+        return False
+    else:
+        if commit:
+            conn.commit()
+    cursor.close()
+    # __________________________________________________________________________
+    return True
+
+
+def pg_find_failed(conn, statements: list) -> (int, str):
+    # Replays the chunk statement by statement to locate the error, nothing is committed
+    cursor = conn.cursor()
+    try:
+        for i, x in enumerate(statements):
+            try:
+                cursor.execute(x)
+            except psycopg2.Error as err:
+                return i, str(err).strip()
+    finally:
+        conn.rollback()
+        cursor.close()
+    # __________________________________________________________________________
+    return -1, "not reproduced statement by statement"
+
+
+def pg_execute_batches(conn, statements: list, batch_size: int, single_transaction: bool = False,
+                       prefix: str = "") -> (bool, int, int):
+    # Returns the result, the number of committed statements and of failed ones (the statements not attempted
+    # after a failure are neither)
+    total = len(statements)
+    done = 0
+    for chunk_indexes in pg_chunks(statements, range(total), batch_size):
+        chunk_start = chunk_indexes[0]
+        chunk = [statements[i] for i in chunk_indexes]
+        if not pg_execute_chunk(conn, chunk, commit=not single_transaction):
+            index, error = pg_find_failed(conn, chunk)
+            if index < 0:
+                print(f"{prefix}[EE] Failed chunk #{chunk_start}-{chunk_start + len(chunk) - 1}: {error}", flush=True)
+            else:
+                print(f"{prefix}[EE] Failed statement #{chunk_start + index}: {chunk[index]}\n{error}", flush=True)
+            if single_transaction:
+                print(f"{prefix}[..] Nothing committed", flush=True)
+                return False, 0, 1
+            print(f"{prefix}[..] Statements before #{chunk_start} are committed, "
+                  "run again to continue", flush=True)
+            return False, done, 1
+        done += len(chunk)
+        print(f"{prefix}[..] Progress: {chunk_start + len(chunk)}/{total}", flush=True)
+    # __________________________________________________________________________
+    if single_transaction:
+        try:
+            conn.commit()
+        except psycopg2.Error as err:
+            print(f"{prefix}[EE] Postgres Exception :: {type(err)}\n{str(err).strip()}", flush=True)
+            return False, 0, 0
+    # __________________________________________________________________________
+    return True, done, 0
+
+
+def pg_chunks(statements: list, indexes, batch_size: int) -> list:
+    # Chunks of statement numbers, a DO block (a chunk of large objects) is a transaction of its own
+    chunks = []
+    chunk = []
+    for i in indexes:
+        if statements[i].startswith('DO '):
+            if chunk:
+                chunks.append(chunk)
+                chunk = []
+            chunks.append([i])
+            continue
+        chunk.append(i)
+        if len(chunk) == batch_size:
+            chunks.append(chunk)
+            chunk = []
+    if chunk:
+        chunks.append(chunk)
+    # __________________________________________________________________________
+    return chunks
+
+
+def pg_large_objects_block(first: str, last: str, role: str) -> str:
+    # The loop runs on the server: one round trip per oid range instead of one per large object
+    _role = role.replace("'", "''")
+    return ("DO $pg_alter_owner_lo$ DECLARE _oid oid; BEGIN "
+            "FOR _oid IN SELECT oid FROM pg_catalog.pg_largeobject_metadata "
+            "WHERE oid BETWEEN {} AND {} AND lomowner <> '{}'::pg_catalog.regrole ORDER BY oid LOOP "
+            "EXECUTE format('ALTER LARGE OBJECT %s OWNER TO {}', _oid); "
+            "END LOOP; END $pg_alter_owner_lo$;").format(int(first), int(last), _role, _role)
+
+
+def pg_lock_aware_block(statements: list, indexes: list) -> str:
+    # Each statement runs in its own subtransaction: a lock timeout skips only that statement.
+    # The wait time and the timeouts are reported back as notices tagged with the statement number.
+    lines = ["DO $pg_alter_owner$ DECLARE _t timestamptz; BEGIN"]
+    for i in indexes:
+        _ms = "round(extract(epoch FROM clock_timestamp() - _t) * 1000)"
+        lines.append("  _t := clock_timestamp(); BEGIN EXECUTE '{}'; RAISE NOTICE '{}|ok|{}|%', {}; "
+                     "EXCEPTION WHEN lock_not_available THEN RAISE NOTICE '{}|timeout|{}|%', {}; END;".format(
+                         statements[i].replace("'", "''"), _LOCK_NOTICE_TAG, i, _ms, _LOCK_NOTICE_TAG, i, _ms))
+    lines.append("END $pg_alter_owner$;")
+    # __________________________________________________________________________
+    return '\n'.join(lines)
+
+
+def pg_execute_batches_lock_aware(conn, statements: list, batch_size: int, lock_timeout: int, retries: int,
+                                  prefix: str = "") -> (bool, int, int, list, dict):
+    # Returns the result, the number of committed and of failed statements, the timed out statement numbers
+    # and the lock waits
+    re_notice = re.compile(r'{}\|(ok|timeout)\|(\d+)\|(\d+)'.format(_LOCK_NOTICE_TAG))
+    conn.notices = collections.deque()  # The default list keeps only the last 50 notices
+    _sql = "SELECT set_config('lock_timeout', %(ms)s, false), set_config('client_min_messages', 'notice', false);"
+    if psql(conn, _sql, {'ms': f"{lock_timeout}ms"}) is None:
+        return False, 0, 0, [], {}
+    done = 0
+    waits = collections.defaultdict(int)  # Statement number -> ms, summed over the attempts
+    pending = list(range(len(statements)))
+    delay = _LOCK_BACKOFF_START
+    for attempt in range(retries + 1):
+        timed_out = []
+        for chunk in pg_chunks(statements, pending, batch_size):
+            conn.notices.clear()
+            if not pg_execute_chunk(conn, [pg_lock_aware_block(statements, chunk)]):
+                index, error = pg_find_failed(conn, [statements[i] for i in chunk])
+                if index < 0:
+                    print(f"{prefix}[EE] Failed chunk of {len(chunk)} statements: {error}", flush=True)
+                else:
+                    print(f"{prefix}[EE] Failed statement #{chunk[index]}: {statements[chunk[index]]}\n{error}",
+                          flush=True)
+                print(f"{prefix}[..] Completed chunks are committed, run again to continue", flush=True)
+                return False, done, 1, timed_out, waits
+            for x in conn.notices:
+                m = re_notice.search(x)
+                if m:
+                    waits[int(m.group(2))] += int(m.group(3))
+                    if m.group(1) == 'timeout':
+                        timed_out.append(int(m.group(2)))
+            done += len(chunk) - len(set(timed_out) & set(chunk))
+            print(f"{prefix}[..] Progress: {done}/{len(statements)}, lock timeouts: {len(timed_out)}", flush=True)
+        if not timed_out:
+            return True, done, 0, [], waits
+        if attempt < retries:
+            print(f"{prefix}[WW] Lock timeout [{len(timed_out)}], retry {attempt + 1}/{retries} in {delay}s",
+                  flush=True)
+            time.sleep(delay)
+            delay *= 2
+        pending = timed_out
+    print(f"{prefix}[EE] Lock timeout [{len(pending)}] after {retries} retries", flush=True)
+    # __________________________________________________________________________
+    return False, done, len(pending), pending, waits
+
+
+def pg_report_lock_waits(statements: list, timed_out: list, waits: dict, prefix: str = ""):
+    if not waits:
+        return
+    print(f"{prefix}[..] Lock waits: total {sum(waits.values())} ms, max {max(waits.values())} ms", flush=True)
+    for i, ms in sorted(waits.items(), key=lambda a: a[1], reverse=True):
+        if ms < _LOCK_REPORT_MIN_MS:
+            break
+        print(f"{prefix}\t{ms:>8} ms  {'TIMEOUT ' if i in timed_out else ''}{statements[i]}", flush=True)
+
+
+def pg_get_databases(args: argparse.Namespace, patterns: list) -> Union[None, list]:
+    try:
+        pg_conn = psycopg2.connect(host=args.host,
+                                   port=args.port,
+                                   user=args.username,
+                                   password=args.password,
+                                   database=args.maintenance_db,
+                                   connect_timeout=10)
+    except (psycopg2.OperationalError, psycopg2.ProgrammingError) as err:
+        print(f"[EE] Postgres Exception :: {type(err)}\n{str(err).strip()}", flush=True)
+        return None
+    except Exception as err:
+        print(f"[!!] Exception: {type(err)}\n{''.join(traceback.format_exc(limit=1))}", flush=True)
+        return None
+    _sql = "SELECT datname FROM pg_catalog.pg_database WHERE datallowconn AND NOT datistemplate ORDER BY datname;"
+    rows = psql(pg_conn, _sql)
+    pg_conn.close()
+    if rows is None:
+        return None
+    # __________________________________________________________________________
+    return [x[0] for x in rows if any(fnmatch.fnmatchcase(x[0], y.strip()) for y in patterns if y.strip())]
+
+
+def psql(conn, query: str, params=None):
+    cursor = pg_query(conn, query, params)
     if cursor is not None:
         if cursor.description is None:
             return []
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# ----------------------------------------------------------------------------------------------------------------------
+import argparse
+import datetime
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import textwrap
+import threading
+import time
+import traceback
+from typing import Union
+
+import psycopg2
+
+_BENCH_DB = "bench"
+_BENCH_ROLES = ['bench_owner_a', 'bench_owner_b']
+_BENCH_APPNAME = "pg_alter_owner_bench"
+_GENERATE_CHUNK = 1000  # DDL statements per round trip while generating the objects
+_SAMPLE_INTERVAL = 0.05  # Seconds between pg_stat_activity samples of the lock waits
+
+
+def main():
+    # __________________________________________________________________________
+    # command-line options, arguments
+    try:
+        parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                         description=textwrap.dedent('''\
+                                         Benchmark pg_alter_owner.py on a generated temporary cluster.
+                                         Arguments after -- are passed to pg_alter_owner.py.'''))
+        parser.add_argument('--bin-dir', action='store', type=str, default="",
+                            metavar='', help="PostgreSQL binaries directory (default: from PATH)")
+        parser.add_argument('--port', action='store', type=int, default=54329,
+                            metavar='', help="temporary cluster port, default: 54329")
+        parser.add_argument('--schemas', action='store', type=int, default=4,
+                            metavar='', help="schemas, default: 4")
+        parser.add_argument('--tables', action='store', type=int, default=1000,
+                            metavar='', help="tables with a serial column per schema, default: 1000")
+        parser.add_argument('--sequences', action='store', type=int, default=100,
+                            metavar='', help="standalone sequences per schema, default: 100")
+        parser.add_argument('--views', action='store', type=int, default=100,
+                            metavar='', help="views per schema, default: 100")
+        parser.add_argument('--load', action='store', type=int, default=0,
+                            metavar='', help="concurrent clients updating random tables, default: 0")
+        parser.add_argument('--load-hold', action='store', type=int, default=50,
+                            metavar='', help="ms a load transaction holds its locks, default: 50")
+        parser.add_argument('--repeat', action='store', type=int, default=1,
+                            metavar='', help="runs, the owner alternates between the runs, default: 1")
+        parser.add_argument('--server-option', action='append', type=str, default=[],
+                            metavar='', help="postgres -c option for the cluster, e.g. max_locks_per_transaction=256")
+        parser.add_argument('--keep', action='store_true',
+                            help="keep the cluster directory and the pg_alter_owner.py logs")
+        parser.add_argument('alter_owner_args', action='store', nargs=argparse.REMAINDER,
+                            help=argparse.SUPPRESS)
+        args = parser.parse_args()
+    except SystemExit:
+        return False
+    # ------------------------------------------------------------------------------------------------------------------
+    if args.alter_owner_args and args.alter_owner_args[0] == '--':
+        args.alter_owner_args = args.alter_owner_args[1:]
+    if min(args.schemas, args.tables, args.repeat) < 1 or min(args.sequences, args.views, args.load) < 0:
+        print("[EE] Invalid --schemas, --tables, --sequences, --views, --load or --repeat value", flush=True)
+        return False
+    if os.geteuid() == 0:
+        print("[EE] initdb cannot be run as root, run as an unprivileged user", flush=True)
+        return False
+    initdb = shutil.which('initdb', path=args.bin_dir or None)
+    pg_ctl = shutil.which('pg_ctl', path=args.bin_dir or None)
+    if not initdb or not pg_ctl:
+        print(f"[EE] initdb or pg_ctl not found: {args.bin_dir or 'PATH'}", flush=True)
+        return False
+    # ==================================================================================================================
+    # ==================================================================================================================
+    # Start
+    # ==================================================================================================================
+    work_dir = tempfile.mkdtemp(prefix="pg_alter_owner_bench_")
+    data_dir = os.path.join(work_dir, 'data')
+    print(f"[..] Cluster directory: {work_dir}", flush=True)
+    started = False
+    try:
+        # ______________________________________________________________________
+        # cluster
+        if shell_exec([initdb, '-D', data_dir, '-U', 'postgres', '-A', 'trust', '-E', 'UTF8', '--no-sync']) is None:
+            return False
+        options = f"-p {args.port} -k {work_dir} -c listen_addresses=''"
+        options += ''.join(f" -c {x}" for x in args.server_option)
+        if shell_exec([pg_ctl, '-D', data_dir, '-l', os.path.join(work_dir, 'postgres.log'), '-o', options,
+                       '-w', 'start']) is None:
+            return False
+        started = True
+        print(f"[OK] Cluster started: {args.port}", flush=True)
+        # ______________________________________________________________________
+        # objects
+        start_dt = datetime.datetime.now()
+        count = bench_generate(work_dir, args)
+        if count is None:
+            return False
+        print(f"[OK] Objects generated [{count}]: {str(datetime.datetime.now() - start_dt).split('.')[0]}",
+              flush=True)
+        # ______________________________________________________________________
+        # runs
+        results = []
+        for i in range(args.repeat):
+            role = _BENCH_ROLES[(i + 1) % 2]
+            print("[--] {}".format('-' * 95), flush=True)
+            print(f"[..] Run {i + 1}/{args.repeat}: {role}, load clients: {args.load}", flush=True)
+            result = bench_run(work_dir, args, role, i + 1)
+            if result is None:
+                return False
+            results.append(result)
+    except Exception as err:
+        print(f"[!!] Exception: {type(err)}\n{''.join(traceback.format_exc(limit=1))}", flush=True)
+        return False
+    finally:
+        if started:
+            shell_exec([pg_ctl, '-D', data_dir, '-m', 'fast', '-w', 'stop'])
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    # ==================================================================================================================
+    # ==================================================================================================================
+    # End
+    # ==================================================================================================================
+    print("[--] {}".format('-' * 95), flush=True)
+    print(f"[..] pg_alter_owner.py {' '.join(args.alter_owner_args)}", flush=True)
+    print("[..] {:>3}  {:>10}  {:>10}  {:>12}  {:>12}  {:>13}  {:>10}  {:>12}".format(
+        'RUN', 'STATEMENTS', 'SECONDS', 'STATEMENTS/S', 'TRANSACTIONS', 'LOCK WAIT MS', 'LOAD TPS', 'LOAD MAX MS'),
+        flush=True)
+    for x in results:
+        print("[{}] {:>3}  {:>10}  {:>10.2f}  {:>12.1f}  {:>12}  {:>13}  {:>10.1f}  {:>12}".format(
+            'OK' if x['result'] else 'EE', x['run'], x['statements'], x['seconds'],
+            x['statements'] / x['seconds'] if x['seconds'] else 0, x['transactions'], x['lock_wait_ms'],
+            x['load_tps'], x['load_max_ms']), flush=True)
+    # __________________________________________________________________________
+    return all(x['result'] for x in results)
+
+
+# ======================================================================================================================
+# Functions
+# ======================================================================================================================
+def bench_connect(work_dir: str, args: argparse.Namespace, dbname: str = _BENCH_DB):
+    conn = psycopg2.connect(host=work_dir, port=args.port, user='postgres', database=dbname,
+                            application_name=_BENCH_APPNAME, connect_timeout=10)
+    conn.autocommit = True
+    return conn
+
+
+def bench_generate(work_dir: str, args: argparse.Namespace) -> Union[None, int]:
+    # All the objects are owned by the first role, the first run moves them to the second one
+    try:
+        conn = bench_connect(work_dir, args, 'postgres')
+        with conn.cursor() as cursor:
+            cursor.execute(f"CREATE DATABASE {_BENCH_DB};")
+            for x in _BENCH_ROLES:
+                cursor.execute(f"CREATE ROLE {x};")
+            cursor.execute(f"ALTER DATABASE {_BENCH_DB} OWNER TO {_BENCH_ROLES[0]};")
+        conn.close()
+        conn = bench_connect(work_dir, args)
+        statements = []
+        for i in range(args.schemas):
+            statements.append(f"CREATE SCHEMA s{i} AUTHORIZATION {_BENCH_ROLES[0]};")
+            for j in range(args.tables):
+                statements.append(f"CREATE TABLE s{i}.t{j} (id serial PRIMARY KEY, v int NOT NULL DEFAULT 0);")
+                statements.append(f"INSERT INTO s{i}.t{j} DEFAULT VALUES;")
+            for j in range(args.sequences):
+                statements.append(f"CREATE SEQUENCE s{i}.q{j};")
+            for j in range(args.views):
+                statements.append(f"CREATE VIEW s{i}.v{j} AS SELECT id, v FROM s{i}.t{j % args.tables};")
+        with conn.cursor() as cursor:
+            cursor.execute(f"SET ROLE {_BENCH_ROLES[0]};")
+            for n in range(0, len(statements), _GENERATE_CHUNK):
+                cursor.execute('\n'.join(statements[n:n + _GENERATE_CHUNK]))
+            cursor.execute("RESET ROLE; ANALYZE;")
+        conn.close()
+    except psycopg2.Error as err:
+        print(f"[EE] Postgres Exception :: {type(err)}\n{str(err).strip()}", flush=True)
+        return None
+    # __________________________________________________________________________
+    return 1 + args.schemas * (1 + 2 * args.tables + args.sequences + args.views)
+
+
+def bench_run(work_dir: str, args: argparse.Namespace, role: str, run: int) -> Union[None, dict]:
+    re_done = re.compile(r'\[OK\] Done: (\d+) statements')
+    re_progress = re.compile(r'\[\.\.\] Progress: ')
+    trg_stop = threading.Event()
+    try:
+        clients = [ThreadLoad(work_dir, args, trg_stop) for _ in range(args.load)]
+        sampler = ThreadLockSampler(work_dir, args, trg_stop)
+    except psycopg2.Error as err:
+        print(f"[EE] Postgres Exception :: {type(err)}\n{str(err).strip()}", flush=True)
+        return None
+    for x in clients + [sampler]:
+        x.start()
+    # __________________________________________________________________________
+    cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pg_alter_owner.py'),
+           '--host', work_dir, '--port', str(args.port), '--username', 'postgres',
+           *args.alter_owner_args, _BENCH_DB, role]
+    env = dict(os.environ, PGAPPNAME=_BENCH_APPNAME + "_target")
+    start = time.monotonic()
+    child = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+    seconds = time.monotonic() - start
+    trg_stop.set()
+    for x in clients + [sampler]:
+        x.join()
+    # __________________________________________________________________________
+    output = child.stdout.decode('utf-8', errors='replace')
+    if args.keep:
+        with open(os.path.join(work_dir, f"run_{run}.log"), 'wt') as f:
+            f.write(output)
+    if child.returncode != 0:
+        print(f"[EE] pg_alter_owner.py exit code: {child.returncode}", flush=True)
+        print('\n'.join(output.splitlines()[-10:]), flush=True)
+    m = re_done.search(output)
+    # One progress line per committed chunk, or a single commit at the end (argparse accepts the prefixes)
+    transactions = len(re_progress.findall(output))
+    if any(x.startswith('--s') and '--single-transaction'.startswith(x) for x in args.alter_owner_args):
+        transactions = 1 if transactions and child.returncode == 0 else 0
+    latencies = sorted(y for x in clients for y in x.latencies)
+    result = {'run': run,
+              'result': child.returncode == 0,
+              'statements': int(m.group(1)) if m else 0,
+              'seconds': seconds,
+              'transactions': transactions,
+              'lock_wait_ms': int(sampler.samples * _SAMPLE_INTERVAL * 1000),
+              'load_tps': len(latencies) / seconds if seconds else 0,
+              'load_max_ms': int(latencies[-1]) if latencies else 0}
+    print("[{}] {} statements in {:.2f}s, {} transactions, lock wait ~{} ms".format(
+        'OK' if result['result'] else 'EE', result['statements'], seconds, result['transactions'],
+        result['lock_wait_ms']), flush=True)
+    # __________________________________________________________________________
+    return result
+
+
+def shell_exec(cmd: list) -> Union[None, str]:
+    try:
+        return subprocess.check_output(cmd, stderr=subprocess.STDOUT).decode('utf-8', errors='replace')
+    except subprocess.CalledProcessError as err:
+        print(f"[EE] Exit code {err.returncode}: {' '.join(cmd)}\n"
+              f"{err.output.decode('utf-8', errors='replace').strip()}", flush=True)
+    except Exception as err:
+        print(f"[!!] Exception: {type(err)}\n{''.join(traceback.format_exc(limit=1))}", flush=True)
+    # __________________________________________________________________________
+    return None
+
+
+# ======================================================================================================================
+# Classes
+# ======================================================================================================================
+class ThreadLoad(threading.Thread):
+    # Short write transactions on random tables, the latencies show the impact on the live traffic
+    def __init__(self, work_dir: str, args: argparse.Namespace, trg_stop: threading.Event):
+        threading.Thread.__init__(self, daemon=True)
+        self.conn = bench_connect(work_dir, args)
+        self.args = args
+        self.trg_stop = trg_stop
+        self.latencies = []
+
+    def run(self):
+        hold = self.args.load_hold / 1000
+        try:
+            with self.conn.cursor() as cursor:
+                while not self.trg_stop.is_set():
+                    table = f"s{random.randrange(self.args.schemas)}.t{random.randrange(self.args.tables)}"
+                    start = time.monotonic()
+                    cursor.execute(f"BEGIN; UPDATE {table} SET v = v + 1 WHERE id = 1; "
+                                   f"SELECT pg_sleep({hold}); COMMIT;")
+                    self.latencies.append((time.monotonic() - start) * 1000)
+        except psycopg2.Error as err:
+            print(f"[EE] Load client :: {type(err)}\n{str(err).strip()}", flush=True)
+        finally:
+            self.conn.close()
+
+
+class ThreadLockSampler(threading.Thread):
+    # Counts the samples where the pg_alter_owner.py session waits for a lock
+    def __init__(self, work_dir: str, args: argparse.Namespace, trg_stop: threading.Event):
+        threading.Thread.__init__(self, daemon=True)
+        self.conn = bench_connect(work_dir, args)
+        self.trg_stop = trg_stop
+        self.samples = 0
+
+    def run(self):
+        _sql = ("SELECT count(*) FROM pg_catalog.pg_stat_activity "
+                "WHERE application_name = %(name)s AND wait_event_type = 'Lock';")
+        try:
+            with self.conn.cursor() as cursor:
+                while not self.trg_stop.wait(_SAMPLE_INTERVAL):
+                    cursor.execute(_sql, {'name': _BENCH_APPNAME + "_target"})
+                    self.samples += cursor.fetchone()[0]
+        except psycopg2.Error as err:
+            print(f"[EE] Lock sampler :: {type(err)}\n{str(err).strip()}", flush=True)
+        finally:
+            self.conn.close()
+
+
+# %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+if __name__ == '__main__':
+    # __________________________________________________________________________
+    sys.exit(not main())  # Compatible return code
@@ -2,22 +2,58 @@
 # -*- coding: utf-8 -*-
 # ----------------------------------------------------------------------------------------------------------------------
 import argparse
+import concurrent.futures
 import datetime
 import hashlib
+import json
 import os
 import re
+import shlex
+import shutil
+import signal
 import socket
+import sqlite3
 import subprocess
 import sys
 import tempfile
+import threading
 import traceback
 from typing import Union
 
 _GLOBALS_NAME = "globals"
 _EXCLUDE_BASE = ["postgres", "template0", "template1"]
+_STATE_FILE_NAME = ".pg_backup_state.json"
+_TOC_INDEX_NAME = "toc.sqlite"
+_STORE_DIR_NAME = ".pg_backup_store"
+_STORE_FILE_REGEXP = r'^\d+\.dat(\.\w+)?$'  # The table data files of directory format dumps
+_TOC_TYPES = sorted([  # pg_restore --list entry types, multi-word first
+    'TABLE DATA', 'SEQUENCE SET', 'SEQUENCE OWNED BY', 'FK CONSTRAINT', 'CHECK CONSTRAINT', 'DEFAULT ACL',
+    'MATERIALIZED VIEW DATA', 'MATERIALIZED VIEW', 'FOREIGN TABLE', 'LARGE OBJECT', 'BLOB', 'BLOBS',
+    'TEXT SEARCH CONFIGURATION', 'TEXT SEARCH DICTIONARY', 'EVENT TRIGGER', 'FOREIGN DATA WRAPPER',
+    'SERVER', 'USER MAPPING', 'INDEX ATTACH', 'TABLE ATTACH', 'PUBLICATION TABLE', 'PUBLICATION',
+    'SUBSCRIPTION', 'STATISTICS', 'ROW SECURITY', 'POLICY', 'TABLE', 'SEQUENCE', 'VIEW', 'INDEX', 'CONSTRAINT',
+    'TRIGGER', 'RULE', 'DEFAULT', 'FUNCTION', 'PROCEDURE', 'AGGREGATE', 'TYPE', 'DOMAIN', 'SCHEMA', 'EXTENSION',
+    'COMMENT', 'ACL', 'COLLATION', 'CONVERSION', 'CAST', 'OPERATOR', 'OPERATOR CLASS', 'OPERATOR FAMILY',
+    'SHELL TYPE', 'ENCODING', 'STDSTRINGS', 'SEARCHPATH', 'DATABASE', 'DATABASE PROPERTIES'], key=len, reverse=True)
+# compress auto
+_AUTO_CODEC_LEVELS = {'gzip': [1, 6, 9], 'lz4': [1, 5, 9], 'zstd': [1, 3, 9]}
+_AUTO_CODEC_CMD = {'gzip': 'gzip -c -{}', 'lz4': 'lz4 -c -{}', 'zstd': 'zstd -c -q -{}'}
+_AUTO_SAMPLE_TABLES = 3  # The number of the largest tables to sample
+_AUTO_SAMPLE_ROWS = 100000  # The maximum number of rows to sample per table
+_AUTO_MAX_AGE_DAYS = 7  # The time to wait before re-tuning a stored choice, in days.
+# space
+_SPACE_DEFAULT_RATIO = 0.5  # The dump/database size ratio assumed without statistics
+_SPACE_CHECK_INTERVAL = 5  # The time to wait between free space checks, in seconds.
+_SPACE_RESERVED = dict()  # Predicted bytes not dumped yet: {device: {cluster name: {database: bytes}}}
+_SPACE_RESERVED_LOCK = threading.Lock()
+
+_CHILDREN = dict()  # Running tracked subprocesses by cluster name
+_CHILDREN_LOCK = threading.Lock()
+_CONTEXT = threading.local()  # Current cluster name of the thread
 
 __START_DT = datetime.datetime.now()
 __HOSTNAME = socket.getfqdn()
+__EVENTS_LOCK = threading.Lock()
 
 
 def main():
@@ -39,9 +75,29 @@ def main():
         parser.add_argument('-e', action='append', type=str, default=list(), dest="exclude",
                             help="exclude database")
         parser.add_argument('-Z', '--compress', action='store', type=str, default="", dest="compress",
-                            help="specify the compression method and/or the compression level")
+                            help="specify the compression method and/or the compression level, "
+                                 "or 'auto' to choose per database")
+        parser.add_argument('--compress-min-speed', action='store', type=float, default=50.0,
+                            dest="compress_min_speed",
+                            help="auto mode: minimum compression throughput, in MB/s (default: 50)")
         parser.add_argument('-j', action='store', type=int, default=0, dest="njobs",
                             help="use this many parallel jobs to dump (default: 0)")
+        parser.add_argument('--progress-interval', action='store', type=int, default=30, dest="progress_interval",
+                            help="seconds between progress reports of a running dump (default: 30)")
+        parser.add_argument('--progress-file', action='store', type=str, default="", dest="progress_file",
+                            help="append progress events as JSON lines to this file")
+        parser.add_argument('--min-free', action='store', type=str, default="1G", dest="min_free",
+                            help="free space to keep on the backup volume, K/M/G/T suffix (default: 1G)")
+        parser.add_argument('--space-policy', action='store', type=str, default="abort", dest="space_policy",
+                            choices=['abort', 'fit', 'ignore'],
+                            help="when the predicted size does not fit: abort, dump what fits smallest first, "
+                                 "or ignore (default: abort)")
+        parser.add_argument('--no-toc-index', action='store_false', dest="toc_index",
+                            help=f"do not index the table of contents of dumps into {_TOC_INDEX_NAME}")
+        parser.add_argument('--dedup', action='store_true',
+                            help=f"with -j, hard-link identical table data files to <path>/{_STORE_DIR_NAME}")
+        parser.add_argument('-c', '--config', action='store', type=str, default="", dest="config",
+                            help="yaml file with clusters to back up concurrently, into <path>/<name>")
         parser.add_argument('-n', '--dry-run', action='store_true',
                             help="testing mode with no changes made")
         parser.add_argument('--help', action='help', help='show this help message and exit')
@@ -63,32 +119,138 @@ def main():
     args.exclude = map(lambda x: x.strip(), args.exclude)
     args.exclude = list(filter(lambda x: x, args.exclude))
     args.exclude = set(args.exclude + _EXCLUDE_BASE)
+    #
+    args.min_free = human_to_bytes(args.min_free)
+    if args.min_free is None:
+        print("[EE] Invalid --min-free value", flush=True)
+        return False
     # __________________________________________________________________________
     if not fs_check_access_dir('rw', args.path):
         return False
     # __________________________________________________________________________
-    pid_file_path = os.path.join(tempfile.gettempdir(), os.path.basename(sys.argv[0]) + '.pid')
+    args.store_path = os.path.join(args.path, _STORE_DIR_NAME)  # Shared by all clusters
+    # __________________________________________________________________________
+    # Configuration
+    clusters = None
+    config = {'max_clusters': 4, 'max_per_host': 1}
+    if args.config:
+        clusters = config_load_clusters(args, config)
+        if clusters is None:
+            return False
+    # __________________________________________________________________________
+    # One pid file per backup path and cluster set, so separate invocations do not clash
+    pid_key = hashlib.md5(f"{args.path}|{args.config or f'{args.host}:{args.port}'}".encode()).hexdigest()[:8]
+    pid_file_path = os.path.join(tempfile.gettempdir(), f"{os.path.basename(sys.argv[0])}.{pid_key}.pid")
     if not pid_mk_file(pid_file_path):
         return False
+    # ==================================================================================================================
+    # ==================================================================================================================
+    # Start
+    # ==================================================================================================================
+    if clusters is None:
+        main_return_value = backup_cluster(args)['result']
+    else:
+        sys.stdout = PrefixedStdout(sys.stdout)
+        semaphore_global = threading.BoundedSemaphore(config['max_clusters'])
+        semaphore_hosts = dict()
+        threads = []
+        for cluster in clusters:
+            semaphore_host = semaphore_hosts.setdefault(cluster.host, threading.BoundedSemaphore(
+                config['max_per_host']))
+            threads.append(ThreadCluster(name=cluster.name, args=cluster,
+                                         semaphores=[semaphore_host, semaphore_global]))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        sys.stdout = sys.stdout.stream
+        # ______________________________________________________________________
+        # Summary
+        print("[--] Summary {}".format('-' * 83), flush=True)
+        cw = max(len(x.name) for x in threads)
+        for thread in threads:
+            x = thread.summary
+            print("[{}] {} {} dumped: {} failed: {} size: {} duration: {} {}".format(
+                'OK' if x['result'] else 'EE', x['name'].ljust(cw), f"{x['host'] or 'local'}:{x['port']}",
+                x['dumped'], len(x['failed']), human_readable_size(x['size']),
+                str(x['duration']).split('.')[0], x['dir']), flush=True)
+            if x['failed']:
+                print(f"\tfailed: {', '.join(x['failed'])}", flush=True)
+            if not x['result']:
+                main_return_value = False
+    # ==================================================================================================================
+    # ==================================================================================================================
+    # End
+    # ==================================================================================================================
+    if args.dedup and not args.dry_run and os.path.isdir(args.store_path):
+        store_stats = dedup_store_gc(args.store_path)
+        if store_stats is None:
+            main_return_value = False
+        else:
+            print(f"[II] Store: {store_stats['files']} files, {human_readable_size(store_stats['size'])} unique, "
+                  f"removed unreferenced: {store_stats['removed']}", flush=True)
+    # __________________________________________________________________________
+    if not fs_rm_file(pid_file_path):
+        main_return_value = False
+    # __________________________________________________________________________
+    return main_return_value
+
+
+def backup_cluster(args: argparse.Namespace) -> dict:
+    summary = {'name': getattr(args, 'name', ''), 'host': args.host, 'port': args.port, 'result': False,
+               'dumped': 0, 'failed': [], 'size': 0, 'duration': datetime.timedelta(), 'dir': ''}
+    main_return_value = True
+    cluster_start_dt = datetime.datetime.now()
     # ------------------------------------------------------------------------------------------------------------------
     # ------------------------------------------------------------------------------------------------------------------
     # Collection of information
     # ------------------------------------------------------------------------------------------------------------------
     pg_version = psql_get_version(args.host, args.port, args.user)
     if pg_version is None:
-        return False
+        return summary
     print(f"[II] Postgres server version: {pg_version}", flush=True)
     # __________________________________________________________________________
     pg_db_list = psql_get_databases(args.host, args.port, args.user)
     if pg_db_list is None:
-        return False
+        return summary
     if _GLOBALS_NAME in pg_db_list:
         print(f"[EE] Database name cannot be: {_GLOBALS_NAME}", flush=True)
-        return False
+        return summary
     pg_db_list = list(filter(lambda x: x not in args.exclude, pg_db_list))
     if not pg_db_list:
         print("[EE] Database list is empty", flush=True)
-        return False
+        return summary
+    # __________________________________________________________________________
+    state_file_path = os.path.join(args.path, _STATE_FILE_NAME)
+    state = state_load(state_file_path)
+    if state is None:
+        return summary
+    # __________________________________________________________________________
+    pg_dump_major = None
+    pg_dump_codecs = []
+    if args.compress:
+        pg_dump_major = pg_dump_get_major_version()
+        if pg_dump_major is None:
+            return summary
+        pg_dump_codecs = pg_dump_get_codecs(args.host, args.port, args.user, pg_db_list[0], pg_dump_major)
+        if not pg_dump_codecs:
+            print("[EE] No compression codecs supported by pg_dump", flush=True)
+            return summary
+        print(f"[II] pg_dump version: {pg_dump_major}, codecs: {', '.join(pg_dump_codecs)}", flush=True)
+        if args.compress != "auto" and not pg_compress_check(args.compress, pg_dump_codecs, pg_dump_major):
+            return summary
+    # __________________________________________________________________________
+    pg_db_sizes = psql_get_database_sizes(args.host, args.port, args.user, pg_db_list[0])
+    if pg_db_sizes is None:
+        return summary
+    space_plan_result = space_plan(args.path, state, args.host, args.port, pg_db_list, pg_db_sizes, args.min_free,
+                                   args.space_policy, getattr(_CONTEXT, 'cluster', ''))
+    if space_plan_result is None:
+        return summary
+    pg_db_list, pg_db_skipped = space_plan_result
+    if pg_db_skipped:
+        summary['failed'] += pg_db_skipped
+        main_return_value = False
     # ==================================================================================================================
     # ==================================================================================================================
     # Start
@@ -97,11 +259,16 @@ def main():
     tmp_backup_dir = os.path.join(args.path, f"{__START_DT.strftime('%Y.%m.%d_%H%M%S')}_tmp")
     good_backup_dir = os.path.join(args.path, f"{__START_DT.strftime('%Y.%m.%d_%H%M%S')}_good")
     error_backup_dir = os.path.join(args.path, f"{__START_DT.strftime('%Y.%m.%d_%H%M%S')}_error")
+    thread_space_guard = None
     if args.dry_run:
         print("[WW] DRY RUN MODE", flush=True)
     else:
         if not fs_mkdir(tmp_backup_dir):
-            return False
+            space_release(getattr(_CONTEXT, 'cluster', ''))
+            return summary
+        thread_space_guard = ThreadSpaceGuard(name="ThreadSpaceGuard", path=args.path, min_free=args.min_free,
+                                              cluster=getattr(_CONTEXT, 'cluster', ''))
+        thread_space_guard.start()
     # ------------------------------------------------------------------------------------------------------------------
     # Globals
     # ------------------------------------------------------------------------------------------------------------------
@@ -127,6 +294,11 @@ def main():
     # Databases
     # ------------------------------------------------------------------------------------------------------------------
     for db in pg_db_list:
+        if thread_space_guard is not None and thread_space_guard.tripped:
+            print(f"[EE] Skipped database, low free space: {db}", flush=True)
+            summary['failed'].append(db)
+            main_return_value = False
+            continue
         print("[..] Dumping database: {} ...".format(db), flush=True)
         if args.njobs == 0:
             dst_path = os.path.join(tmp_backup_dir, f"{db}.pg_dump")
@@ -134,15 +306,46 @@ def main():
         else:
             dst_path = os.path.join(tmp_backup_dir, f"{db}")
             tmp_path = os.path.join(tmp_backup_dir, f"_tmp_{db}")
+        compress = args.compress
+        if args.compress == "auto":
+            compress = pg_compress_choose(args, state, db, pg_dump_codecs, pg_dump_major, tmp_backup_dir)
+            if not args.dry_run and not state_save(state_file_path, state):
+                main_return_value = False
+        # ______________________________________________________________________
+        key = state_key(args.host, args.port, db)
+        thread_monitor = None
+        db_size = None
+        if not args.dry_run:
+            db_size = pg_db_sizes.get(db)
+            ratio = state['databases'].get(key, {}).get('ratio')
+            expected_size = int(db_size * ratio) if db_size and ratio else None
+            thread_monitor = ThreadMonitor(name="ThreadMonitor", host=args.host, port=args.port, user=args.user,
+                                           dbname=db, path=tmp_path, expected_size=expected_size,
+                                           interval=args.progress_interval, events_path=args.progress_file,
+                                           cluster=getattr(_CONTEXT, 'cluster', ''))
+            thread_monitor.start()
         start_dt = datetime.datetime.now()
-        if not pg_dump_database(args.host, args.port, args.user, db, tmp_path, args.compress, args.njobs, args.dry_run):
+        dump_result = pg_dump_database(args.host, args.port, args.user, db, tmp_path, compress, args.njobs,
+                                       args.dry_run)
+        if thread_monitor is not None:
+            thread_monitor.stop(dump_result)
+            thread_monitor.join()
+        space_release(getattr(_CONTEXT, 'cluster', ''), db)  # Written, or removed on failure
+        if not dump_result:
+            summary['failed'].append(db)
             main_return_value = False
+            if thread_space_guard is not None and thread_space_guard.tripped:
+                print(f"[..] Removing partial dump: {tmp_path}", flush=True)
+                fs_rm_path(tmp_path)
         else:
             if not args.dry_run:
                 duration = datetime.datetime.now() - start_dt
+                dump_size = fs_size_bytes(tmp_path)
                 if not fs_move(tmp_path, dst_path):
+                    summary['failed'].append(db)
                     main_return_value = False
                 else:
+                    summary['dumped'] += 1
                     print("[OK] Successfully dumped", flush=True)
                     print(f"\tpath: {dst_path}", flush=True)
                     if args.njobs == 0:
@@ -152,22 +355,57 @@ def main():
                         print(f"\tsize: {fs_sizeof_dir(dst_path)}", flush=True)
 
                     print(f"\tduration: {duration}", flush=True)
+                    # Only the bytes not shared with the store take new space
+                    new_size = dump_size or 0
+                    if args.dedup and args.njobs != 0:
+                        dedup_stats = dedup_dump_dir(dst_path, args.store_path, args.njobs)
+                        if dedup_stats is None:
+                            print("[WW] Deduplication failed", flush=True)
+                        else:
+                            new_size = max(new_size - dedup_stats['saved'], 0)
+                            print(f"\tdedup: {dedup_stats['linked']}/{dedup_stats['files']} files linked, "
+                                  f"saved: {human_readable_size(dedup_stats['saved'])}", flush=True)
+                    summary['size'] += new_size
+                    if args.toc_index:
+                        toc_count = toc_index_dump(os.path.join(tmp_backup_dir, _TOC_INDEX_NAME), db, dst_path,
+                                                   tmp_backup_dir)
+                        if toc_count is None:
+                            print("[WW] Table of contents is not indexed", flush=True)
+                        else:
+                            print(f"\ttoc: {toc_count} entries", flush=True)
                     print(f"[--]", flush=True)
+                    # __________________________________________________________
+                    # statistics for the next runs
+                    if db_size and dump_size is not None:
+                        state['databases'].setdefault(key, {}).update({
+                            'db_size': db_size,
+                            'dump_size': dump_size,
+                            'ratio': dump_size / db_size,
+                            'duration': duration.total_seconds(),
+                            'compress': compress,
+                            'dt': __START_DT.isoformat(),
+                        })
+                        if not state_save(state_file_path, state):
+                            main_return_value = False
     # ==================================================================================================================
     # ==================================================================================================================
     # End
     # ==================================================================================================================
+    if thread_space_guard is not None:
+        thread_space_guard.stop()
+        thread_space_guard.join()
+    space_release(getattr(_CONTEXT, 'cluster', ''))
     if not args.dry_run:
         dst_path = good_backup_dir if main_return_value else error_backup_dir
         if not fs_move(tmp_backup_dir, dst_path):
             main_return_value = False
         else:
+            summary['dir'] = dst_path
             print(f"[{'OK' if main_return_value else 'EE'}] Done: {dst_path}", flush=True)
     # __________________________________________________________________________
-    if not fs_rm_file(pid_file_path):
-        main_return_value = False
-    # __________________________________________________________________________
-    return main_return_value
+    summary['result'] = main_return_value
+    summary['duration'] = datetime.datetime.now() - cluster_start_dt
+    return summary
 
 
 # ======================================================================================================================
@@ -257,19 +495,57 @@ def fs_rm_file(path: str) -> bool:
     return True
 
 
-def shell_exec(cmd: str, shell: str = "/bin/bash") -> (int, str):
+def shell_exec(cmd: str, shell: str = "/bin/bash", track: bool = False) -> (int, str):
+    # Tracked commands run in their own process group, see ps_kill_tracked()
     child = subprocess.Popen(cmd,
                              shell=True,
                              executable=shell,
                              stdout=subprocess.PIPE,
                              stderr=subprocess.STDOUT,
-                             stdin=subprocess.PIPE)
-    stdout = child.communicate()[0]
+                             stdin=subprocess.PIPE,
+                             start_new_session=track)
+    if track:
+        with _CHILDREN_LOCK:
+            _CHILDREN[child] = getattr(_CONTEXT, 'cluster', '')
+    try:
+        stdout = child.communicate()[0]
+    finally:
+        if track:
+            with _CHILDREN_LOCK:
+                _CHILDREN.pop(child, None)
     returncode = child.returncode
     # __________________________________________________________________________
     return returncode, stdout.decode("utf-8").strip()
 
 
+def ps_kill_tracked(cluster: str = '', signum: int = signal.SIGTERM):
+    with _CHILDREN_LOCK:
+        children = [child for child, name in _CHILDREN.items() if name == cluster]
+    for child in children:
+        try:
+            os.killpg(child.pid, signum)
+        except ProcessLookupError:
+            pass
+        except Exception as err:
+            print(f"[!!] Exception: {type(err)}\n{''.join(traceback.format_exc(limit=1))}", flush=True)
+
+
+def human_readable_size(size: float, delimiter: str = ' ') -> str:
+    for x in ['bytes', 'KB', 'MB', 'GB', 'TB']:
+        if abs(size) < 1024.0:
+            return "{0:0.2f}{1}{2}".format(size, delimiter, x)
+        size /= 1024.0
+    return "{0:0.2f}{1}{2}".format(size, delimiter, 'PB')
+
+
+def human_to_bytes(value: str) -> Union[None, int]:
+    match = re.search(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*$', value, re.IGNORECASE)
+    if not match:
+        return None
+    # __________________________________________________________________________
+    return int(float(match.group(1)) * 1024 ** ' KMGT'.index(match.group(2).upper() or ' '))
+
+
 def fs_sizeof_file(path: str, delimiter: str = ' ') -> str:
     # noinspection PyBroadException
     try:
@@ -309,6 +585,48 @@ def fs_md5sum_file(path: str) -> str:
         return ""
 
 
+def fs_size_bytes(path: str) -> Union[None, int]:
+    # noinspection PyBroadException
+    try:
+        if os.path.isdir(path):
+            return sum(d.stat().st_size for d in os.scandir(path) if d.is_file())
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
+    except Exception as err:
+        print(f"[!!] Exception: {type(err)}\n{''.join(traceback.format_exc(limit=1))}", flush=True)
+        return None
+
+
+def progress_event(path: str, data: dict) -> bool:
+    if not path:
+        return True
+    data = {'ts': datetime.datetime.now().isoformat(), 'host': __HOSTNAME,
+            'cluster': getattr(_CONTEXT, 'cluster', ''), **data}
+    try:
+        with __EVENTS_LOCK:
+            with open(path, 'at', encoding='utf-8') as f:
+                f.write(json.dumps(data) + '\n')
+    except Exception as err:
+        print(f"[!!] Exception: {type(err)}\n{''.join(traceback.format_exc(limit=1))}", flush=True)
+        return False
+    # __________________________________________________________________________
+    return True
+
+
+def fs_rm_path(path: str) -> bool:
+    try:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+    except Exception as err:
+        print(f"[!!] Exception: {type(err)}\n{''.join(traceback.format_exc(limit=1))}", flush=True)
+        return False
+    # __________________________________________________________________________
+    return True
+
+
 def fs_move(src_path: str, dst_path: str) -> bool:
     if os.path.exists(dst_path):
         print(f"[EE] Destination already exists: {dst_path}", flush=True)
@@ -322,9 +640,465 @@ def fs_move(src_path: str, dst_path: str) -> bool:
     return True
 
 
+def state_load(path: str) -> Union[None, dict]:
+    if not os.path.exists(path):
+        return {'databases': {}}
+    try:
+        with open(path, 'rt', encoding='utf-8') as f:
+            data = json.load(f)
+    except Exception as err:
+        print(f"[!!] Exception: {type(err)}\n{''.join(traceback.format_exc(limit=1))}", flush=True)
+        return None
+    # __________________________________________________________________________
+    if not isinstance(data, dict):
+        print(f"[EE] Invalid state file: {path}", flush=True)
+        return None
+    data.setdefault('databases', {})
+    return data
+
+
+def state_save(path: str, data: dict) -> bool:
+    tmp_path = f"{path}_tmp"
+    try:
+        with open(tmp_path, 'wt', encoding='utf-8') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except Exception as err:
+        print(f"[!!] Exception: {type(err)}\n{''.join(traceback.format_exc(limit=1))}", flush=True)
+        return False
+    # __________________________________________________________________________
+    return True
+
+
+def state_key(host: str, port: int, dbname: str) -> str:
+    return f"{host or 'local'}:{port}/{dbname}"
+
+
+def yaml_load_file(path: str) -> Union[None, dict]:
+    try:
+        from ruamel.yaml import YAML
+    except ImportError:
+        print("[EE] Python module is required for --config: ruamel.yaml", flush=True)
+        return None
+    yaml = YAML()
+    try:
+        with open(path, 'rt', encoding='utf-8') as f:
+            data = yaml.load(f)
+    except Exception as err:
+        print(f"[!!] Exception: {type(err)}\n{''.join(traceback.format_exc(limit=1))}", flush=True)
+        return None
+    # __________________________________________________________________________
+    if data is None:
+        return dict()
+    # __________________________________________________________________________
+    return data  # <class 'ruamel.yaml.comments.CommentedMap'>
+
+
+def config_load_clusters(args: argparse.Namespace, config: dict) -> Union[None, list]:
+    re_simple_str = re.compile(r"^([\w\-]+)$")
+    config_data_yaml = yaml_load_file(args.config)
+    if config_data_yaml is None:
+        return None
+    for x in config.keys():
+        if config_data_yaml.get(x) is not None:
+            if not isinstance(config_data_yaml.get(x), int) or config_data_yaml.get(x) < 1:
+                print(f"[EE] Invalid {x}: {config_data_yaml.get(x)}", flush=True)
+                return None
+            config[x] = config_data_yaml.get(x)
+    #
+    config_clusters_yaml = config_data_yaml.get('clusters')
+    if not isinstance(config_clusters_yaml, list) or not config_clusters_yaml:
+        print("[EE] Invalid configuration file", flush=True)
+        return None
+    # __________________________________________________________________________
+    clusters = []
+    for item in config_clusters_yaml:
+        cluster = argparse.Namespace(**vars(args))
+        cluster.name = item.get('name')
+        if not isinstance(cluster.name, str) or not re_simple_str.search(cluster.name):
+            print(f"[EE] Invalid cluster name: {cluster.name}", flush=True)
+            return None
+        if cluster.name in [x.name for x in clusters]:
+            print(f"[EE] Duplicate cluster found: {cluster.name}", flush=True)
+            return None
+        for key, types in [('host', str), ('port', int), ('user', str), ('njobs', int), ('compress', str)]:
+            if item.get(key) is not None:
+                if not isinstance(item.get(key), types):
+                    print(f"[EE] Invalid cluster {cluster.name} {key}: {item.get(key)}", flush=True)
+                    return None
+                setattr(cluster, key, item.get(key))
+        if item.get('exclude') is not None:
+            if not isinstance(item.get('exclude'), list):
+                print(f"[EE] Invalid cluster {cluster.name} exclude: {item.get('exclude')}", flush=True)
+                return None
+            cluster.exclude = args.exclude | set(filter(lambda x: x, map(lambda x: str(x).strip(), item['exclude'])))
+        cluster.path = os.path.join(args.path, cluster.name)
+        clusters.append(cluster)
+    # __________________________________________________________________________
+    return clusters
+
+
+# ======================================================================================================================
+# Dedup Functions
+# ======================================================================================================================
+def fs_sha256sum_file(path: str) -> str:
+    sha256 = hashlib.sha256()
+    # noinspection PyBroadException
+    try:
+        with open(path, 'rb') as f:
+            while chunk := f.read(1048576):
+                sha256.update(chunk)
+            return sha256.hexdigest()
+    except Exception as err:
+        print(f"[!!] Exception: {type(err)}\n{''.join(traceback.format_exc(limit=1))}", flush=True)
+        return ""
+
+
+def dedup_dump_dir(dump_path: str, store_path: str, njobs: int) -> Union[None, dict]:
+    re_data_file = re.compile(_STORE_FILE_REGEXP)
+    stats = {'files': 0, 'linked': 0, 'saved': 0}
+    try:
+        files = [x.path for x in os.scandir(dump_path) if x.is_file() and re_data_file.search(x.name)]
+        # hashlib releases the GIL on large buffers, so threads hash in parallel
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(njobs, 1)) as executor:
+            digests = list(executor.map(fs_sha256sum_file, files))
+        # ______________________________________________________________________
+        for path, digest in zip(files, digests):
+            if not digest:
+                continue
+            stats['files'] += 1
+            store_file = os.path.join(store_path, digest[:2], digest)
+            if not os.path.exists(store_file):
+                os.makedirs(os.path.dirname(store_file), exist_ok=True)
+                try:
+                    os.link(path, store_file)
+                    continue
+                except FileExistsError:
+                    pass  # Added by a concurrent cluster
+            if os.path.samefile(path, store_file):
+                continue
+            tmp_path = f"{path}_tmp"
+            os.link(store_file, tmp_path)
+            stats['saved'] += os.path.getsize(path)
+            os.replace(tmp_path, path)
+            stats['linked'] += 1
+    except Exception as err:
+        print(f"[!!] Exception: {type(err)}\n{''.join(traceback.format_exc(limit=1))}", flush=True)
+        return None
+    # __________________________________________________________________________
+    return stats
+
+
+def dedup_store_gc(store_path: str) -> Union[None, dict]:
+    # A store file linked only once is not referenced by any backup
+    stats = {'files': 0, 'size': 0, 'removed': 0}
+    try:
+        for root, dirs, files in os.walk(store_path):
+            for x in files:
+                path = os.path.join(root, x)
+                stat = os.stat(path)
+                if stat.st_nlink == 1:
+                    os.remove(path)
+                    stats['removed'] += 1
+                else:
+                    stats['files'] += 1
+                    stats['size'] += stat.st_size
+    except Exception as err:
+        print(f"[!!] Exception: {type(err)}\n{''.join(traceback.format_exc(limit=1))}", flush=True)
+        return None
+    # __________________________________________________________________________
+    return stats
+
+
+# ======================================================================================================================
+# TOC Functions
+# ======================================================================================================================
+def toc_parse_line(line: str) -> Union[None, dict]:
+    # 3012; 0 16385 TABLE DATA public orders postgres
+    match = re.search(r'^(\d+);\s+(\d+)\s+(\d+)\s+(.+)$', line)
+    if not match:
+        return None
+    rest = match.group(4)
+    for x in _TOC_TYPES:
+        if rest.startswith(x + ' '):
+            fields = rest[len(x) + 1:].split(' ')
+            if len(fields) < 3:
+                # the owner is omitted for some entries
+                fields.append('')
+            return {'entry_id': int(match.group(1)), 'type': x, 'schema': fields[0],
+                    'name': ' '.join(fields[1:-1]), 'owner': fields[-1], 'line': line}
+    # __________________________________________________________________________
+    return None
+
+
+def toc_index_dump(index_path: str, dbname: str, dump_path: str, base_dir: str) -> Union[None, int]:
+    cmd = '''pg_restore -l "{}"'''.format(dump_path)
+    rc, rd = shell_exec(cmd)
+    if rc != 0:
+        print("[EE] Shell command executed. Exit code: {0}\n{1}\n{2}\n{1}\n{3}\n{1}".format(
+            rc, "-  " * 33 + "-", cmd, rd), flush=True)
+        return None
+    entries = list(filter(lambda x: x, map(toc_parse_line, rd.split('\n'))))
+    # __________________________________________________________________________
+    try:
+        conn = sqlite3.connect(index_path)
+        with conn:
+            conn.executescript('''
+                CREATE TABLE IF NOT EXISTS dumps (id INTEGER PRIMARY KEY, db TEXT, file TEXT UNIQUE, format TEXT,
+                  size INTEGER, dt TEXT);
+                CREATE TABLE IF NOT EXISTS toc (dump_id INTEGER, entry_id INTEGER, type TEXT, schema TEXT,
+                  name TEXT, owner TEXT, line TEXT);
+                CREATE INDEX IF NOT EXISTS toc_name ON toc (name, schema);
+                CREATE INDEX IF NOT EXISTS toc_dump ON toc (dump_id);
+            ''')
+            conn.execute("DELETE FROM toc WHERE dump_id IN (SELECT id FROM dumps WHERE file = ?)",
+                         (os.path.relpath(dump_path, base_dir),))
+            conn.execute("DELETE FROM dumps WHERE file = ?", (os.path.relpath(dump_path, base_dir),))
+            cursor = conn.execute("INSERT INTO dumps (db, file, format, size, dt) VALUES (?, ?, ?, ?, ?)",
+                                  (dbname, os.path.relpath(dump_path, base_dir),
+                                   'directory' if os.path.isdir(dump_path) else 'custom',
+                                   fs_size_bytes(dump_path), __START_DT.isoformat()))
+            conn.executemany("INSERT INTO toc (dump_id, entry_id, type, schema, name, owner, line) "
+                             "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             [(cursor.lastrowid, x['entry_id'], x['type'], x['schema'], x['name'], x['owner'],
+                               x['line']) for x in entries])
+        conn.close()
+    except Exception as err:
+        print(f"[!!] Exception: {type(err)}\n{''.join(traceback.format_exc(limit=1))}", flush=True)
+        return None
+    # __________________________________________________________________________
+    return len(entries)
+
+
+# ======================================================================================================================
+# Space Functions
+# ======================================================================================================================
+def space_plan(path: str, state: dict, host: str, port: int, dbs: list, sizes: dict, min_free: int,
+               policy: str, cluster: str = '') -> Union[None, tuple]:
+    # The free space of the volume (the path may not exist yet) minus the reservations of the other clusters
+    # running on it, the planned databases are reserved in turn until dumped
+    with _SPACE_RESERVED_LOCK:
+        try:
+            parent = fs_existing_parent(path)
+            free = shutil.disk_usage(parent).free
+            device = os.stat(parent).st_dev
+        except Exception as err:
+            print(f"[!!] Exception: {type(err)}\n{''.join(traceback.format_exc(limit=1))}", flush=True)
+            return None
+        reserved = sum(sum(v.values()) for k, v in _SPACE_RESERVED.get(device, {}).items() if k != cluster)
+        plan = space_fit(state, host, port, dbs, sizes, free, reserved, min_free, policy)
+        if plan is not None:
+            _SPACE_RESERVED.setdefault(device, {})[cluster] = {x: plan[2][x] for x in plan[0]}
+    # __________________________________________________________________________
+    return None if plan is None else plan[:2]
+
+
+def space_fit(state: dict, host: str, port: int, dbs: list, sizes: dict, free: int, reserved: int, min_free: int,
+              policy: str) -> Union[None, tuple]:
+    predicted = {}
+    for db in dbs:
+        ratio = state['databases'].get(state_key(host, port, db), {}).get('ratio', _SPACE_DEFAULT_RATIO)
+        predicted[db] = int(sizes.get(db, 0) * ratio)
+    available = free - reserved - min_free
+    total = sum(predicted.values())
+    print(f"[II] Space plan: predicted {human_readable_size(total)}, free {human_readable_size(free)}, "
+          f"reserved {human_readable_size(min_free)}"
+          f"{f', other clusters {human_readable_size(reserved)}' if reserved else ''}", flush=True)
+    if total <= available:
+        return dbs, [], predicted
+    # __________________________________________________________________________
+    if policy == 'ignore':
+        print("[WW] Predicted size exceeds free space, ignored", flush=True)
+        return dbs, [], predicted
+    if policy == 'abort':
+        print("[EE] Predicted size exceeds free space, aborted", flush=True)
+        for db in sorted(dbs, key=lambda x: predicted[x], reverse=True):
+            print(f"\t{db}: {human_readable_size(predicted[db])}", flush=True)
+        return None
+    # fit: as many databases as possible, the smallest first
+    planned = []
+    skipped = []
+    for db in sorted(dbs, key=lambda x: predicted[x]):
+        if predicted[db] <= available:
+            planned.append(db)
+            available -= predicted[db]
+        else:
+            skipped.append(db)
+            print(f"[EE] Skipped database, does not fit: {db} ({human_readable_size(predicted[db])})", flush=True)
+    return planned, skipped, predicted
+
+
+def space_release(cluster: str, db: str = None):
+    # The reservation of a database once dumped, or of the whole cluster
+    with _SPACE_RESERVED_LOCK:
+        for clusters in _SPACE_RESERVED.values():
+            if cluster not in clusters:
+                continue
+            if db is None:
+                clusters.pop(cluster)
+            else:
+                clusters[cluster].pop(db, None)
+
+
+def fs_existing_parent(path: str) -> str:
+    # The path or its nearest existing parent directory, the one whose volume the path will be on
+    path = os.path.abspath(path)
+    while not os.path.exists(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    return path
+
+
+# ======================================================================================================================
+# Compress Functions
+# ======================================================================================================================
+def pg_compress_spec(codec: str, level: int, pg_dump_major: int) -> str:
+    # Before v16 pg_dump accepts only a gzip level
+    if pg_dump_major < 16:
+        return str(level)
+    return f"{codec}:{level}"
+
+
+def pg_compress_check(spec: str, codecs: list, pg_dump_major: int, quiet: bool = False) -> bool:
+    # Before v16 pg_dump accepts only a gzip level, then [method][:level or detail] of the probed codecs
+    codec, _, detail = spec.partition(':')
+    if pg_dump_major < 16:
+        error = "" if re.fullmatch(r'\d', spec) else f"pg_dump {pg_dump_major} accepts only a level 0-9"
+    elif re.fullmatch(r'\d', spec):
+        error = ""
+    elif codec not in codecs + ['none']:
+        error = f"method not supported by pg_dump: {codec}"
+    elif detail and not re.fullmatch(r'\d+|\w+(=\w+)?(,\w+(=\w+)?)*', detail):
+        error = f"invalid level or detail: {detail}"
+    else:
+        error = ""
+    if error and not quiet:
+        print(f"[EE] Invalid compression {spec}: {error}", flush=True)
+    # __________________________________________________________________________
+    return not error
+
+
+def pg_compress_choose(args: argparse.Namespace, state: dict, dbname: str, codecs: list, pg_dump_major: int,
+                       tmp_dir: str) -> str:
+    key = state_key(args.host, args.port, dbname)
+    stored = state['databases'].get(key, {}).get('compress_auto')
+    if stored:
+        age = __START_DT - datetime.datetime.fromisoformat(stored['dt'])
+        if age.days < _AUTO_MAX_AGE_DAYS and pg_compress_check(stored['compress'], codecs, pg_dump_major, quiet=True):
+            print(f"[..] Compression (stored): {stored['compress']}", flush=True)
+            return stored['compress']
+    if args.dry_run:
+        print("[..] Compression (auto): tuning skipped in dry run mode", flush=True)
+        return ""
+    # __________________________________________________________________________
+    print(f"[..] Compression (auto): tuning ...", flush=True)
+    choice = pg_compress_autotune(args.host, args.port, args.user, dbname, codecs, pg_dump_major,
+                                  args.compress_min_speed, tmp_dir)
+    if choice is None:
+        print("[WW] Compression (auto): tuning failed, using pg_dump default", flush=True)
+        return ""
+    state['databases'].setdefault(key, {})['compress_auto'] = choice
+    print(f"[..] Compression (auto): {choice['compress']} ratio: {choice['ratio']:.3f} "
+          f"speed: {choice['speed']:.1f} MB/s", flush=True)
+    return choice['compress']
+
+
+def pg_compress_autotune(host: str, port: int, user: str, dbname: str, codecs: list, pg_dump_major: int,
+                         min_speed: float, tmp_dir: str) -> Union[None, dict]:
+    tables = psql_get_largest_tables(host, port, user, dbname, _AUTO_SAMPLE_TABLES)
+    if not tables:
+        return None
+    # __________________________________________________________________________
+    # sample
+    sample_path = os.path.join(tmp_dir, f"_sample_{dbname}.copy")
+    for table in tables:
+        sql = f"COPY (SELECT * FROM {table} LIMIT {_AUTO_SAMPLE_ROWS}) TO STDOUT;"
+        cmd = '''psql -h "{}" -p "{}" -U "{}" -d "{}" -c {} >> "{}"'''.format(
+            host, port, user, dbname, shlex.quote(sql), sample_path)
+        rc, rd = shell_exec(cmd)
+        if rc != 0:
+            print("[EE] Shell command executed. Exit code: {0}\n{1}\n{2}\n{1}\n{3}\n{1}".format(
+                rc, "-  " * 33 + "-", cmd, rd), flush=True)
+            fs_rm_file(sample_path)
+            return None
+    try:
+        sample_size = os.path.getsize(sample_path)
+    except Exception as err:
+        print(f"[!!] Exception: {type(err)}\n{''.join(traceback.format_exc(limit=1))}", flush=True)
+        return None
+    if sample_size == 0:
+        fs_rm_file(sample_path)
+        return None
+    # __________________________________________________________________________
+    # measure
+    results = []
+    for codec in codecs:
+        if shutil.which(codec) is None:
+            print(f"[WW] Compression (auto): util not found, skipped: {codec}", flush=True)
+            continue
+        for level in _AUTO_CODEC_LEVELS[codec]:
+            cmd = '''{} < "{}" | wc -c'''.format(_AUTO_CODEC_CMD[codec].format(level), sample_path)
+            start_dt = datetime.datetime.now()
+            rc, rd = shell_exec(cmd)
+            duration = (datetime.datetime.now() - start_dt).total_seconds()
+            if rc != 0 or not rd.isdigit():
+                continue
+            results.append({
+                'compress': pg_compress_spec(codec, level, pg_dump_major),
+                'ratio': int(rd) / sample_size,
+                'speed': sample_size / 1048576 / max(duration, 0.001),
+            })
+            print(f"\t{codec}:{level} ratio: {results[-1]['ratio']:.3f} speed: {results[-1]['speed']:.1f} MB/s",
+                  flush=True)
+    fs_rm_file(sample_path)
+    if not results:
+        return None
+    # __________________________________________________________________________
+    # The smallest output that keeps up with the target throughput, otherwise the fastest
+    fit = list(filter(lambda x: x['speed'] >= min_speed, results))
+    if fit:
+        choice = min(fit, key=lambda x: (x['ratio'], -x['speed']))
+    else:
+        choice = max(results, key=lambda x: x['speed'])
+    choice['dt'] = __START_DT.isoformat()
+    return choice
+
+
 # ======================================================================================================================
 # PG Functions
 # ======================================================================================================================
+def pg_dump_get_major_version() -> Union[None, int]:
+    cmd = '''pg_dump --version'''
+    rc, rd = shell_exec(cmd)
+    match = re.search(r'\s(\d+)(\.\d+)?', rd)
+    if rc != 0 or not match:
+        print("[EE] Shell command executed. Exit code: {0}\n{1}\n{2}\n{1}\n{3}\n{1}".format(
+            rc, "-  " * 33 + "-", cmd, rd), flush=True)
+        return None
+    # __________________________________________________________________________
+    return int(match.group(1))
+
+
+def pg_dump_get_codecs(host: str, port: int, user: str, dbname: str, pg_dump_major: int) -> list:
+    if pg_dump_major < 16:
+        return ['gzip']
+    # A build may lack lz4/zstd support, so probe each codec with an empty dump: all the schemas excluded,
+    # which never fails on the database contents. Only the error on the compression option rejects the codec.
+    codecs = []
+    for codec in ['gzip', 'lz4', 'zstd']:
+        cmd = '''pg_dump -h "{}" -p "{}" -U "{}" --schema-only --exclude-schema="*" --compress="{}" ''' \
+              '''-f /dev/null "{}"'''.format(host, port, user, codec, dbname)
+        rc, rd = shell_exec(cmd)
+        if rc != 0 and 'compress' in rd.lower():
+            continue
+        if rc != 0:
+            print(f"[WW] Compression probe failed, {codec} assumed supported: {rd}", flush=True)
+        codecs.append(codec)
+    # __________________________________________________________________________
+    return codecs
+
+
 def psql_get_version(host: str, port: int, user: str) -> Union[None, str]:
     sql = "SHOW server_version;"
     cmd = '''psql -h "{}" -p "{}" -U "{}" -tA -c "{}"'''.format(host, port, user, sql)
@@ -353,13 +1127,59 @@ def psql_get_databases(host: str, port: int, user: str) -> Union[None, list]:
     return list(_tmp)
 
 
+def psql_query(host: str, port: int, user: str, dbname: str, sql: str) -> Union[None, list]:
+    cmd = '''psql -h "{}" -p "{}" -U "{}" -d "{}" -tA -c {}'''.format(host, port, user, dbname, shlex.quote(sql))
+    rc, rd = shell_exec(cmd)
+    if rc != 0:
+        print("[EE] Shell command executed. Exit code: {0}\n{1}\n{2}\n{1}\n{3}\n{1}".format(
+            rc, "-  " * 33 + "-", cmd, rd), flush=True)
+        return None
+    # __________________________________________________________________________
+    return list(filter(lambda x: x, rd.split('\n')))
+
+
+def psql_get_largest_tables(host: str, port: int, user: str, dbname: str, limit: int) -> Union[None, list]:
+    sql = f"""SELECT format('%I.%I', n.nspname, c.relname) FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE c.relkind = 'r' AND n.nspname NOT IN ('pg_catalog', 'information_schema', 'pg_toast')
+    ORDER BY pg_total_relation_size(c.oid) DESC LIMIT {limit};"""
+    return psql_query(host, port, user, dbname, sql)
+
+
+def psql_get_database_sizes(host: str, port: int, user: str, dbname: str) -> Union[None, dict]:
+    sql = "SELECT datname, pg_database_size(datname) FROM pg_database WHERE datallowconn;"
+    rows = psql_query(host, port, user, dbname, sql)
+    if rows is None:
+        return None
+    # __________________________________________________________________________
+    return {x.rsplit('|', 1)[0]: int(x.rsplit('|', 1)[1]) for x in rows}
+
+
+def psql_get_dump_activity(host: str, port: int, user: str, dbname: str) -> Union[None, dict]:
+    # pg_dump reads table data with COPY, reported by pg_stat_progress_copy (v14+)
+    sql = f"""SELECT count(*), coalesce(max(now() - a.xact_start)::text, ''),
+      coalesce(sum(p.bytes_processed), 0),
+      coalesce(string_agg(p.relid::regclass::text, ',' ORDER BY p.relid), '')
+    FROM pg_stat_activity a
+    LEFT JOIN pg_stat_progress_copy p ON p.pid = a.pid
+    WHERE a.datname = current_database() AND a.application_name = 'pg_dump' AND a.pid <> pg_backend_pid();"""
+    rows = psql_query(host, port, user, dbname, sql)
+    if not rows:
+        return None
+    fields = rows[0].split('|')
+    if len(fields) != 4:
+        return None
+    # __________________________________________________________________________
+    return {'backends': int(fields[0]), 'xact_age': fields[1], 'copy_bytes': int(fields[2]), 'copy_tables': fields[3]}
+
+
 def pg_dump_globals(host: str, port: int, user: str, path: str, dry_run: bool = False) -> bool:
     cmd = '''pg_dumpall -h "{}" -p "{}" -U "{}" --globals-only -f "{}"'''.format(host, port, user, path)
     if dry_run:
         print("\t{}".format(cmd), flush=True)
         return True
     # __________________________________________________________________________
-    rc, rd = shell_exec(cmd)
+    rc, rd = shell_exec(cmd, track=True)
     if rc != 0:
         print("[EE] Shell command executed. Exit code: {0}\n{1}\n{2}\n{1}\n{3}\n{1}".format(
             rc, "-  " * 33 + "-", cmd, rd), flush=True)
@@ -381,7 +1201,7 @@ def pg_dump_database(host: str, port: int, user: str, dbname: str, path: str, co
         print("\t{}".format(cmd), flush=True)
         return True
     # __________________________________________________________________________
-    rc, rd = shell_exec(cmd)
+    rc, rd = shell_exec(cmd, track=True)
     if rc != 0:
         print("[EE] Shell command executed. Exit code: {0}\n{1}\n{2}\n{1}\n{3}\n{1}".format(
             rc, "-  " * 33 + "-", cmd, rd), flush=True)
@@ -390,6 +1210,148 @@ def pg_dump_database(host: str, port: int, user: str, dbname: str, path: str, co
     return True
 
 
+# ======================================================================================================================
+# Classes
+# ======================================================================================================================
+class ThreadMonitor(threading.Thread):
+    def __init__(self, name: str, host: str, port: int, user: str, dbname: str, path: str,
+                 expected_size: Union[None, int], interval: int, events_path: str = "", cluster: str = ''):
+        threading.Thread.__init__(self)
+        self.name = name
+        self.cluster = cluster
+        self.host = host
+        self.port = port
+        self.user = user
+        self.dbname = dbname
+        self.path = path
+        self.expected_size = expected_size
+        self.interval = max(interval, 1)
+        self.events_path = events_path
+        self.trg_stop = threading.Event()
+        self.trg_activity = True
+        self.result = None
+
+    def run(self):
+        _CONTEXT.cluster = self.cluster
+        start_dt = datetime.datetime.now()
+        progress_event(self.events_path, {'event': 'start', 'db': self.dbname, 'expected_size': self.expected_size})
+        last_size = 0
+        last_dt = start_dt
+        while not self.trg_stop.wait(self.interval):
+            now_dt = datetime.datetime.now()
+            size = fs_size_bytes(self.path) or 0
+            rate = (size - last_size) / max((now_dt - last_dt).total_seconds(), 0.001)
+            avg_rate = size / max((now_dt - start_dt).total_seconds(), 0.001)
+            last_size, last_dt = size, now_dt
+            # __________________________________________________________________
+            eta = None
+            percent = None
+            if self.expected_size:
+                percent = min(size / self.expected_size * 100, 99.9)
+                if avg_rate > 0:
+                    eta = max(self.expected_size - size, 0) / avg_rate
+            activity = {}
+            if self.trg_activity:
+                activity = psql_get_dump_activity(self.host, self.port, self.user, self.dbname)
+                if activity is None:
+                    print("[WW] Progress: server activity is not available, disabled", flush=True)
+                    self.trg_activity = False
+                    activity = {}
+            # __________________________________________________________________
+            print("[..] Progress: {} size: {:.1f} MB rate: {:.2f} MB/s{}{} backends: {} copy: {}".format(
+                self.dbname, size / 1048576, rate / 1048576,
+                f" ({percent:.1f}%)" if percent is not None else "",
+                f" ETA: {datetime.timedelta(seconds=int(eta))}" if eta is not None else "",
+                activity.get('backends', '?'), activity.get('copy_tables') or '-'), flush=True)
+            progress_event(self.events_path, {
+                'event': 'progress', 'db': self.dbname, 'size': size, 'rate': rate, 'avg_rate': avg_rate,
+                'percent': percent, 'eta': eta, 'elapsed': (now_dt - start_dt).total_seconds(), **activity})
+        # ______________________________________________________________________
+        progress_event(self.events_path, {
+            'event': 'end', 'db': self.dbname, 'result': self.result, 'size': fs_size_bytes(self.path),
+            'elapsed': (datetime.datetime.now() - start_dt).total_seconds()})
+
+    def stop(self, result: bool = None):
+        self.result = result
+        self.trg_stop.set()
+
+
+class ThreadCluster(threading.Thread):
+    def __init__(self, name: str, args: argparse.Namespace, semaphores: list):
+        threading.Thread.__init__(self)
+        self.name = name
+        self.args = args
+        self.semaphores = semaphores  # The per host first, then the global
+        self.summary = {'name': name, 'host': args.host, 'port': args.port, 'result': False,
+                        'dumped': 0, 'failed': [], 'size': 0, 'duration': datetime.timedelta(), 'dir': ''}
+
+    def run(self):
+        _CONTEXT.cluster = self.name
+        for x in self.semaphores:
+            x.acquire()
+        try:
+            print(f"[..] Cluster starting: {self.args.host or 'local'}:{self.args.port} ...", flush=True)
+            if self.args.dry_run or fs_mkdir(self.args.path):
+                self.summary = backup_cluster(self.args)
+        except Exception as err:
+            print(f"[!!] Exception: {type(err)}\n{''.join(traceback.format_exc(limit=1))}", flush=True)
+        finally:
+            for x in reversed(self.semaphores):
+                x.release()
+
+
+class PrefixedStdout:
+    # Prefixes every line with the cluster name of the writing thread
+    def __init__(self, stream):
+        self.stream = stream
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def write(self, data: str) -> int:
+        prefix = getattr(_CONTEXT, 'cluster', '')
+        if not prefix:
+            with self.lock:
+                return self.stream.write(data)
+        *lines, self.local.buffer = (getattr(self.local, 'buffer', '') + data).split('\n')
+        if lines:
+            with self.lock:
+                self.stream.write(''.join(f"{prefix} | {x}\n" for x in lines))
+        return len(data)
+
+    def flush(self):
+        with self.lock:
+            self.stream.flush()
+
+
+class ThreadSpaceGuard(threading.Thread):
+    def __init__(self, name: str, path: str, min_free: int, cluster: str = ''):
+        threading.Thread.__init__(self)
+        self.name = name
+        self.path = path
+        self.min_free = min_free
+        self.cluster = cluster
+        self.trg_stop = threading.Event()
+        self.tripped = False
+
+    def run(self):
+        _CONTEXT.cluster = self.cluster
+        while not self.trg_stop.wait(_SPACE_CHECK_INTERVAL):
+            try:
+                free = shutil.disk_usage(self.path).free
+            except Exception as err:
+                print(f"[!!] Exception: {type(err)}\n{''.join(traceback.format_exc(limit=1))}", flush=True)
+                continue
+            if free < self.min_free and not self.tripped:
+                print(f"[EE] Low free space: {human_readable_size(free)} < {human_readable_size(self.min_free)}, "
+                      f"stopping", flush=True)
+                self.tripped = True
+            if self.tripped:
+                ps_kill_tracked(self.cluster)
+
+    def stop(self):
+        self.trg_stop.set()
+
+
 # %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
 if __name__ == '__main__':
     print("{0}\n{1} PID={2} PPID={3} HOST={4} NAME={5}\n{0}".format(
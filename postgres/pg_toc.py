@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# ----------------------------------------------------------------------------------------------------------------------
+import argparse
+import glob
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import traceback
+from typing import Union
+
+_TOC_INDEX_NAME = "toc.sqlite"
+_TOC_RESTORE_TYPES = ['TABLE', 'TABLE DATA', 'SEQUENCE', 'SEQUENCE SET', 'SEQUENCE OWNED BY', 'VIEW',
+                      'MATERIALIZED VIEW', 'MATERIALIZED VIEW DATA', 'DEFAULT', 'CONSTRAINT', 'FK CONSTRAINT',
+                      'CHECK CONSTRAINT', 'TRIGGER', 'RULE', 'POLICY', 'ROW SECURITY', 'ACL', 'COMMENT']
+
+
+def main():
+    # __________________________________________________________________________
+    # command-line options, arguments
+    try:
+        parser = argparse.ArgumentParser(
+            description='Find and restore objects of pg_backup.py dumps using the table of contents index.')
+        subparsers = parser.add_subparsers(dest="command", required=True)
+        # find
+        parser_find = subparsers.add_parser('find', help="list dumps containing the objects")
+        parser_find.add_argument('path', action='store', type=str,
+                                 help="backup directory path")
+        parser_find.add_argument('pattern', action='store', type=str,
+                                 help="object name or schema.name, '*' is a wildcard")
+        parser_find.add_argument('-t', '--type', action='store', type=str, default="",
+                                 help="object type, e.g. 'TABLE' (default: any)")
+        # restore
+        parser_restore = subparsers.add_parser('restore', add_help=False, help="restore the objects with pg_restore")
+        parser_restore.add_argument('path', action='store', type=str,
+                                    help="backup directory path")
+        parser_restore.add_argument('pattern', action='store', type=str,
+                                    help="table name or schema.name, '*' is a wildcard")
+        parser_restore.add_argument('-d', action='store', type=str, required=True, dest="target",
+                                    help="target database")
+        parser_restore.add_argument('--db', action='store', type=str, default="", dest="source",
+                                    help="source database, if the objects exist in several dumps")
+        parser_restore.add_argument('--backup', action='store', type=str, default="",
+                                    help="backup directory name (default: the latest one containing the objects)")
+        parser_restore.add_argument('-h', action='store', type=str, default="", dest="host",
+                                    help="database server host or socket directory (default: local socket)")
+        parser_restore.add_argument('-p', action='store', type=int, default=5432, dest="port",
+                                    help="database server port number (default: 5432)")
+        parser_restore.add_argument('-U', action='store', type=str, default="postgres", dest="user",
+                                    help="connect as specified database user (default: postgres)")
+        parser_restore.add_argument('-a', '--data-only', action='store_true', dest="data_only",
+                                    help="restore only the data, not the schema")
+        parser_restore.add_argument('-n', '--dry-run', action='store_true',
+                                    help="testing mode with no changes made")
+        parser_restore.add_argument('--help', action='help', help='show this help message and exit')
+        args = parser.parse_args()  # <class 'argparse.Namespace'>
+    except SystemExit:
+        return False
+    # __________________________________________________________________________
+    schema, name = toc_split_pattern(args.pattern)
+    indexes = toc_find_indexes(os.path.abspath(args.path))
+    if not indexes:
+        print(f"[EE] No {_TOC_INDEX_NAME} found: {args.path}", flush=True)
+        return False
+    # ==================================================================================================================
+    # find
+    # ==================================================================================================================
+    if args.command == 'find':
+        found = False
+        for index_path in indexes:
+            rows = toc_query(index_path, schema, name, [args.type.upper()] if args.type else [])
+            if rows is None:
+                return False
+            for x in rows:
+                found = True
+                print(f"{os.path.join(os.path.dirname(index_path), x['file'])}\t{x['line']}", flush=True)
+        return found
+    # ==================================================================================================================
+    # restore
+    # ==================================================================================================================
+    for index_path in indexes:
+        if args.backup and os.path.basename(os.path.dirname(index_path)) != args.backup:
+            continue
+        rows = toc_query(index_path, schema, name, _TOC_RESTORE_TYPES, dependents=True)
+        if rows is None:
+            return False
+        if args.source:
+            rows = list(filter(lambda x: x['db'] == args.source, rows))
+        if args.data_only:
+            rows = list(filter(lambda x: x['type'] in ('TABLE DATA', 'SEQUENCE SET'), rows))
+        if rows:
+            break
+    else:
+        print(f"[EE] Objects not found: {args.pattern}", flush=True)
+        return False
+    # __________________________________________________________________________
+    dumps = sorted(set(x['file'] for x in rows))
+    if len(dumps) > 1:
+        print(f"[EE] Objects found in several dumps, use --db: {', '.join(dumps)}", flush=True)
+        return False
+    dump_path = os.path.join(os.path.dirname(index_path), dumps[0])
+    print(f"[..] Dump: {dump_path}", flush=True)
+    # __________________________________________________________________________
+    list_path = ""
+    try:
+        with tempfile.NamedTemporaryFile('wt', prefix="pg_toc_", suffix=".list", delete=False) as f:
+            list_path = f.name
+            for x in sorted(rows, key=lambda a: a['entry_id']):
+                f.write(x['line'] + '\n')
+                print(f"\t{x['line']}", flush=True)
+        return pg_restore_list(args, list_path, dump_path)
+    except Exception as err:
+        print(f"[!!] Exception: {type(err)}\n{''.join(traceback.format_exc(limit=1))}", flush=True)
+        return False
+    finally:
+        if list_path:
+            fs_rm_file(list_path)
+
+
+# ======================================================================================================================
+# Functions
+# ======================================================================================================================
+def pg_restore_list(args: argparse.Namespace, list_path: str, dump_path: str) -> bool:
+    cmd = ['pg_restore', '-h', args.host, '-p', str(args.port), '-U', args.user, '-d', args.target,
+           '-L', list_path, dump_path]
+    if args.data_only:
+        cmd.insert(-1, '--data-only')
+    print(f"$ {' '.join(cmd)}", flush=True)
+    if args.dry_run:
+        print("[WW] DRY RUN MODE", flush=True)
+        return True
+    # __________________________________________________________________________
+    rc = subprocess.call(cmd)
+    if rc != 0:
+        print(f"[EE] pg_restore exit code: {rc}", flush=True)
+        return False
+    # __________________________________________________________________________
+    return True
+
+
+def fs_rm_file(path: str) -> bool:
+    try:
+        os.remove(path)
+    except Exception as err:
+        print(f"[!!] Exception: {type(err)}\n{''.join(traceback.format_exc(limit=1))}", flush=True)
+        return False
+    # __________________________________________________________________________
+    return True
+
+
+def toc_split_pattern(pattern: str) -> (str, str):
+    # SQLite GLOB patterns, case-sensitive: '*' stays the only wildcard, '[' and '?' are literal
+    schema, _, name = pattern.rpartition('.')
+    return tuple(x.replace('[', '[[]').replace('?', '[?]') for x in (schema, name))
+
+
+def toc_find_indexes(path: str) -> list:
+    # <path>/<dt>_good/ or, with --config, <path>/<cluster>/<dt>_good/
+    indexes = glob.glob(os.path.join(path, '*_good', _TOC_INDEX_NAME))
+    indexes += glob.glob(os.path.join(path, '*', '*_good', _TOC_INDEX_NAME))
+    # __________________________________________________________________________
+    return sorted(indexes, key=lambda x: os.path.basename(os.path.dirname(x)), reverse=True)  # The latest first
+
+
+def toc_query(index_path: str, schema: str, name: str, types: list,
+              dependents: bool = False) -> Union[None, list]:
+    sql = '''SELECT d.db, d.file, t.entry_id, t.type, t.schema, t.name, t.line FROM toc t
+    JOIN dumps d ON d.id = t.dump_id
+    WHERE (t.name GLOB :name{})'''.format(
+        # The dependents: "<table> <constraint>", "<table> <trigger>"..., then "TABLE <table>" of ACL and COMMENT
+        " OR t.name GLOB :name || ' *' OR t.name GLOB '* ' || :name" if dependents else "")
+    if schema:
+        sql += " AND t.schema GLOB :schema"
+    if types:
+        sql += " AND t.type IN ({})".format(', '.join(f":type{i}" for i in range(len(types))))
+    sql += " ORDER BY d.file, t.entry_id"
+    params = {'name': name, 'schema': schema, **{f"type{i}": x for i, x in enumerate(types)}}
+    try:
+        conn = sqlite3.connect(f"file:{index_path}?mode=ro", uri=True)
+        conn.row_factory = sqlite3.Row
+        rows = [dict(x) for x in conn.execute(sql, params)]
+        conn.close()
+    except Exception as err:
+        print(f"[!!] Exception: {type(err)}\n{''.join(traceback.format_exc(limit=1))}", flush=True)
+        return None
+    # __________________________________________________________________________
+    return rows
+
+
+# %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+if __name__ == '__main__':
+    # __________________________________________________________________________
+    sys.exit(not main())  # Compatible return code